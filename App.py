@@ -1,13 +1,26 @@
 #!/usr/bin/env python
 
 import os
-import sys
+import time
+
+from Startup import Startup
+
 import pygame
 
 import config
 
 from Controls import Controls
 from Game import Game
+from CarAI import CarAI
+from Evaluator import Evaluator
+from Evolution import Evolution
+from Termination import Termination
+from Sensors import Sensors
+from Timings import Timings
+from Map import Map
+
+Startup.stage('imports')
+
 
 class App(Controls):
 
@@ -16,14 +29,26 @@ class App(Controls):
 
     BG_COLOR = (10, 10, 50)
 
+    FPS = 60
+    DELTA_TIME = 1 / FPS        # Fixed simulation time step
+    FRAME_TIME_MAX = .25        # Longer frames are not caught up (in seconds)
+    STEPS_PER_FRAME_MAX = 256
+    CAPTION_INTERVAL = 500      # Window title (FPS, steps per frame) refresh, in milliseconds
+
     __CONTROLS__ = {
         config.KEYS.APP.QUIT: 'Quit the program',
+        config.KEYS.APP.SPEED.UP: 'Double the simulation steps per frame',
+        config.KEYS.APP.SPEED.DOWN: 'Halve the simulation steps per frame',
     }
-    __CONTROLS_SUBCLASSES__ = [ Game ]
+    __CONTROLS_SUBCLASSES__ = [ Game, Timings ]
 
-    def __init__(self, map_files, pop_count=0, brain_file=None):
+    def __init__(self, map_files, pop_count=0, brain_file=None, seed=None, checkpoint_file=None):
         self._init_pygame(App.W, App.H)
-        self._init_game(map_files, pop_count, brain_file)
+        Startup.stage('display')
+        self._init_game(map_files, pop_count, brain_file, seed, checkpoint_file)
+        Startup.stage('game')
+        self._game.warmup()
+        Startup.stage('kernels')
 
         self.print_controls()
 
@@ -38,16 +63,47 @@ class App(Controls):
         pygame.display.set_caption('Cars AI')
 
         self._clock = pygame.time.Clock()
-        self._font = pygame.font.SysFont("freesansbold", 25)
+
+        # Window title last set, and when (see update_caption)
+        self._caption = None
+        self._caption_ticks = 0
 
         self._running = False
 
-    def _init_game(self, maps_files, pop_count, brain_file):
-        self._game = Game(maps_files, self._screen, pop_count, brain_file)
+        # Simulation time not simulated yet, and how many fixed steps are simulated per frame at FPS
+        self._accumulator = 0.
+        self._steps_per_frame = 1
+
+    def _init_game(self, maps_files, pop_count, brain_file, seed, checkpoint_file):
+        self._game = Game(maps_files, self._screen, pop_count, brain_file, seed, checkpoint_file)
+
+        # A resumed training goes on with its own time step
+        if self._game.delta_time is not None and self._game.delta_time != self.DELTA_TIME:
+            print(f'Resuming with the time step of the checkpoint: {self._game.delta_time}')
+            self.DELTA_TIME = self._game.delta_time
 
     @property
     def window_title(self):
-        return f'Cars AI - FPS: {self._clock.get_fps():.2f}'
+        return f'Cars AI - FPS: {self._clock.get_fps():.2f} - Steps/frame: {self._steps_per_frame}'
+
+    def update_caption(self):
+        """The window title is set every CAPTION_INTERVAL only, and when it changed"""
+        ticks = pygame.time.get_ticks()
+        if ticks - self._caption_ticks < self.CAPTION_INTERVAL and self._caption is not None:
+            return
+        self._caption_ticks = ticks
+
+        caption = self.window_title
+        if caption != self._caption:
+            self._caption = caption
+            pygame.display.set_caption(caption)
+
+    @property
+    def steps_per_frame(self):
+        return self._steps_per_frame
+
+    def set_steps_per_frame(self, steps_per_frame):
+        self._steps_per_frame = min(max(int(steps_per_frame), 1), self.STEPS_PER_FRAME_MAX)
 
     @property
     def running(self):
@@ -59,43 +115,197 @@ class App(Controls):
                 continue
 
             if event.type == pygame.KEYDOWN:
-                if event.key == config.KEYS.APP.QUIT:
+                if self.is_event_control(event, config.KEYS.APP.QUIT):
                     self._game.end_game()
                     self._running = False
                     return
+                if self.is_event_control(event, config.KEYS.APP.SPEED.UP):
+                    self.set_steps_per_frame(self._steps_per_frame * 2)
+                if self.is_event_control(event, config.KEYS.APP.SPEED.DOWN):
+                    self.set_steps_per_frame(self._steps_per_frame // 2)
 
             self._game.event(event)
+            Timings.event(event)
 
     def update(self):
-        delta_time = self._clock.get_time() / 1000
+        """
+        Runs the fixed time steps of the elapsed frame time (scaled by the steps per frame),
+        so the simulation does not depend on the frame rate
+        """
+        frame_time = min(self._clock.get_time() / 1000, self.FRAME_TIME_MAX)
+        self._accumulator += frame_time * self._steps_per_frame
 
-        self._game.update(delta_time)
+        steps = min(int(self._accumulator / self.DELTA_TIME), 2 * self._steps_per_frame)
+        for _ in range(steps):
+            self._game.update(self.DELTA_TIME)
+        self._accumulator = min(self._accumulator - steps * self.DELTA_TIME, self.DELTA_TIME)
 
     def draw(self):
         self._screen.fill(App.BG_COLOR)
 
-        self._game.draw(debug=True)
+        # Cars are drawn between their last 2 steps, by the simulation time not simulated yet
+        self._game.draw(debug=True, alpha=min(self._accumulator / self.DELTA_TIME, 1.))
+
+        Timings.draw(self._screen)
 
         pygame.display.update()
 
     def run(self):
+        Startup.report()
+
         self._running = True
         while self._running:
-            self._clock.tick(60)
-            pygame.display.set_caption(self.window_title)
+            self._clock.tick(self.FPS)
+            self.update_caption()
 
+            start = Timings.start()
             self.events()
+            Timings.stop('events', start)
+
             self.update()
+
+            start = Timings.start()
             self.draw()
+            Timings.stop('draw', start)
+
+            Timings.end_frame()
+
+        Timings.export()
+
+
+class HeadlessApp(object):
+    """
+    Trainer without any display: each generation is evaluated to completion with a fixed
+    delta time (no frame rate cap, no drawing), possibly over a pool of worker processes,
+    and the simulation throughput is reported.
+    """
+
+    DELTA_TIME = App.DELTA_TIME     # Same time step as the App
+    REPORT_INTERVAL = 10.   # in seconds
+
+    def __init__(self, map_files, pop_count, brain_file=None, delta_time=DELTA_TIME, seed=None, workers=1, checkpoint_file=None):
+        assert pop_count > 0 or checkpoint_file is not None, "Headless mode needs a population (no manual mode)"
+
+        self._delta_time = delta_time
+        self._steps = 0
+        self._cars_steps = 0
+
+        self._game = Game(map_files, None, pop_count, brain_file, seed, checkpoint_file)
+        self._evaluator = Evaluator(workers)
+
+        # A resumed training goes on with its own time step
+        if self._game.delta_time is not None and self._game.delta_time != self._delta_time:
+            print(f'Resuming with the time step of the checkpoint: {self._game.delta_time}')
+            self._delta_time = self._game.delta_time
+        Startup.stage('game')
+        self._game.warmup(self._evaluator)
+        Startup.stage('kernels' if self._evaluator.workers == 1 else 'workers start')
+
+    def _report(self, elapsed):
+        steps_per_sec = self._steps / elapsed if elapsed > 0 else 0.
+        cars_steps_per_sec = self._cars_steps / elapsed if elapsed > 0 else 0.
+        print(f'[headless] {self._game.generations_count} generations, {self._steps} steps '
+              f'in {elapsed:.1f}s ({steps_per_sec:.1f} steps/s, {cars_steps_per_sec:.0f} cars steps/s, '
+              f'{self._evaluator.workers} workers)')
+
+    def run(self, generations=None):
+        Startup.report()
+
+        start = time.perf_counter()
+        last_report = start
+
+        try:
+            while generations is None or \
+                  self._game.generations_count < generations:
+                cars_count = self._game.cars_count
+                steps = self._game.evaluate_generation(self._evaluator, self._delta_time)
+                self._steps += steps
+                self._cars_steps += steps * cars_count
+
+                now = time.perf_counter()
+                if now - last_report >= self.REPORT_INTERVAL:
+                    last_report = now
+                    self._report(now - start)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._evaluator.close()
+            self._game.end_game()
+            self._report(time.perf_counter() - start)
+            Timings.export()
 
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('-n', '--pop_count', type=int, default=0)
-    parser.add_argument('-m', '--map_files', nargs='+', default=None, required=True)
-    parser.add_argument('-b', '--brain_file', default=None)
+    parser.add_argument('-m', '--map_files', nargs='+', default=None)
+    parser.add_argument('-b', '--brain_file', default=None, help='Brain file (.json or .npz) or population archive (.npz) to start from')
+    parser.add_argument('--brain_format', choices=Game.BRAIN_FORMATS, default=Game.BRAIN_FORMAT, help='File format of the saved brains')
+    parser.add_argument('--save_population', action='store_true', help='Also archive the brains of the whole generation when quitting')
+    parser.add_argument('--selection', choices=Evolution.SELECTIONS, default=Evolution.SELECTION, help='Selection of the parents of the next generation')
+    parser.add_argument('--tournament_size', type=int, default=Evolution.TOURNAMENT_SIZE, help='Genomes drawn by each tournament selection')
+    parser.add_argument('--crossover', choices=Evolution.CROSSOVERS, default=Evolution.CROSSOVER, help='Crossover of the selected parents')
+    parser.add_argument('--elitism', type=int, default=Evolution.ELITISM, help='Count of best brains kept unchanged in the next generation')
+    parser.add_argument('--fitness_progress', action='store_true', help='Fitness from the continuous progress along the track instead of the stonemiles reached')
+    parser.add_argument('--step_budget', type=int, default=Termination.STEP_BUDGET, help='Steps after which a generation is ended (0 for no limit)')
+    parser.add_argument('--stall_steps', type=int, default=Termination.STALL_STEPS, help='End a generation when no car reached a new stonemile for this count of steps (0 to disable)')
+    parser.add_argument('--cannot_beat', action='store_true', help='End a generation when no alive car can beat the best one before the step budget runs out')
+    parser.add_argument('-s', '--seed', type=int, default=None, help='Seed of the random generators to replay a run')
+    parser.add_argument('--sensors_count', type=int, default=None, help=f'Sensors count, evenly spread over {Sensors.SENSORS_FIELD_OF_VIEW} degrees')
+    parser.add_argument('--sensors_angles', type=float, nargs='+', default=None, help='Angle of each sensor (in degrees, 0 is forward)')
+    parser.add_argument('--raycasting', choices=Sensors.RAYCASTING_MODES, default=Sensors.RAYCASTING_MODES[0], help='Sensors raycasting mode')
+    parser.add_argument('--sense_cars', action='store_true', help='Sensors rays are stopped by the other cars too (multi-car racing)')
+    parser.add_argument('--no_map_cache', action='store_true', help=f'Do not use the compiled maps cache ({Map.CACHE_DIR})')
+    parser.add_argument('--mask_bitpacked', action='store_true', help='Store the collision mask with 8 pixels per byte (smaller, lookups a bit slower)')
+    parser.add_argument('--headless', action='store_true', help='Train without display nor frame rate cap')
+    parser.add_argument('-g', '--generations', type=int, default=None, help='Generations to train in headless mode (default: until CTRL+C)')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Worker processes evaluating the generations in headless mode')
+    parser.add_argument('--delta_time', type=float, default=HeadlessApp.DELTA_TIME, help='Fixed simulation time step in headless mode')
+    parser.add_argument('--resume', default=None, help='Resume the training saved in this checkpoint (maps, population count and sensors are the saved ones)')
+    parser.add_argument('--checkpoint', default=Game.CHECKPOINT_FILE, help='File of the training checkpoints')
+    parser.add_argument('--checkpoint_every', type=int, default=Game.CHECKPOINT_EVERY, help='Generations between two checkpoints (0 to disable them)')
+    parser.add_argument('--timings', default=None, help='.csv or .json file the timings of the game loop phases are exported to at exit (only the phases run in this process)')
     args = parser.parse_args()
 
-    a = App(map_files=args.map_files, pop_count=args.pop_count, brain_file=args.brain_file)
-    a.run()
+    if args.map_files is None and args.resume is None:
+        parser.error('the following arguments are required: -m/--map_files (or --resume)')
+
+    if args.sensors_angles is not None:
+        Sensors.set_sensors_angles(args.sensors_angles)
+    elif args.sensors_count is not None:
+        Sensors.set_sensors_count(args.sensors_count)
+    Sensors.set_raycasting_mode(args.raycasting)
+    Sensors.set_sensing_cars(args.sense_cars)
+
+    if args.no_map_cache:
+        Map.CACHE_DIR = None
+    Map.MASK_BITPACKED = args.mask_bitpacked
+
+    Evolution.SELECTION = args.selection
+    Evolution.TOURNAMENT_SIZE = args.tournament_size
+    Evolution.CROSSOVER = args.crossover
+    Evolution.ELITISM = args.elitism
+
+    CarAI.FITNESS_PROGRESS = args.fitness_progress
+
+    Termination.set_settings(args.step_budget, args.stall_steps, args.cannot_beat)
+
+    Game.BRAIN_FORMAT = args.brain_format
+    Game.SAVE_POPULATION = args.save_population
+    Game.CHECKPOINT_FILE = args.checkpoint
+    Game.CHECKPOINT_EVERY = args.checkpoint_every
+
+    Timings.EXPORT_FILE = args.timings
+    Timings.enable(args.timings is not None)
+
+    if args.headless:
+        if args.pop_count <= 0 and args.resume is None:
+            parser.error('--headless needs a population count (-n) greater than 0')
+        a = HeadlessApp(map_files=args.map_files, pop_count=args.pop_count, brain_file=args.brain_file,
+                        delta_time=args.delta_time, seed=args.seed, workers=args.workers, checkpoint_file=args.resume)
+        a.run(generations=args.generations)
+    else:
+        a = App(map_files=args.map_files, pop_count=args.pop_count, brain_file=args.brain_file, seed=args.seed,
+                checkpoint_file=args.resume)
+        a.run()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import platform
+import contextlib
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import numpy as np
+import numba
+import pygame
+from pygame.math import Vector2 as Vec
+
+from App import App
+from CacheMath import CacheMath
+from CarAI import CarAI
+from Evolution import Evolution
+from Game import Game
+from Map import Map
+from Neuron import NeuralNetwork as NN, NeuralNetworkBatch
+from Sensors import Sensors
+from SpatialGrid import SpatialGrid
+
+
+class Benchmark(object):
+    """
+    Micro-benchmarks of the simulation hot paths and macro-benchmarks of Game.update.
+    Every result is a time per operation (in seconds, lower is better), so a run can be
+    compared to a baseline run to flag the regressions.
+    """
+
+    MAP_FILES = ['maps/hungary.svg', 'maps/spain.svg']
+    CARS_COUNTS = [10, 100, 1000, 10000]
+    REGRESSION_THRESHOLD = .1       # Relative slowdown flagged as a regression
+
+    def __init__(self, quick=False, repeat=5, filter_name=None):
+        self._quick = quick
+        self._repeat = repeat
+        self._filter = filter_name
+        self._results = {}
+
+        self._maps = {}
+        self._rng = np.random.default_rng(0)
+
+    @property
+    def results(self):
+        return self._results
+
+    def _map(self, map_file):
+        if map_file not in self._maps:
+            self._maps[map_file] = Map(map_file)
+        return self._maps[map_file]
+
+    def _road_points(self, game_map, count):
+        """Random points on the road of `game_map` [count, 2]"""
+        xs, ys = np.nonzero(game_map.distance_array)
+        picked = self._rng.integers(0, len(xs), count)
+        return np.column_stack((xs[picked] + self._rng.random(count), ys[picked] + self._rng.random(count)))
+
+    def _measure(self, name, func, ops=1, repeat=None, unit='op'):
+        """Best time of `repeat` runs of func() (after a warmup run), divided by the `ops` it does"""
+        if self._filter is not None and self._filter not in name:
+            return
+
+        func()
+        best = float('inf')
+        for _ in range(repeat or self._repeat):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+
+        self._results[name] = {'time': best / ops, 'unit': f's/{unit}', 'ops': ops}
+        print(f'{name:<48} {best / ops * 1e6:>14.3f} us/{unit}')
+
+    def bench_sensors(self):
+        for map_file in self.MAP_FILES:
+            game_map = self._map(map_file)
+            count = 1000
+            positions = self._road_points(game_map, count)
+            headings = self._rng.uniform(-180., 180., count)
+            for mode in Sensors.RAYCASTING_MODES:
+                Sensors.set_raycasting_mode(mode)
+                self._measure(f'sensors.raycast[{mode}]/{os.path.basename(map_file)}',
+                              lambda: Sensors.raycast(game_map, positions, headings), ops=count, unit='car')
+            Sensors.set_raycasting_mode(Sensors.RAYCASTING_MODES[0])
+
+            # Rays stopped by the other cars too, grid update included
+            ids = np.arange(count)
+            sensors_length = Sensors.raycast(game_map, positions, headings)
+            grid = SpatialGrid(game_map.size)
+            def raycast_cars():
+                grid.update(positions, ids)
+                Sensors.raycast_cars(grid, positions, headings, ids, sensors_length.copy(), positions, headings)
+            self._measure(f'sensors.raycast_cars/{os.path.basename(map_file)}', raycast_cars, ops=count, unit='car')
+            self._measure(f'spatial_grid.query_radius/{os.path.basename(map_file)}',
+                          lambda: grid.query_radius(positions, Sensors.SENSOR_SIZE_MAX, exclude=ids), ops=count, unit='car')
+
+    def bench_neural_network(self):
+        shape = CarAI.brain_shape()
+        inputs = self._rng.random(shape[0])
+        nn = NN(*shape)
+        self._measure('nn.forward', lambda: nn.forward(inputs), ops=1)
+
+        count = 1000
+        genomes = self._rng.uniform(-1, 1, (count, NN.params_count(*shape)))
+        brains = [NN.from_genome(genome, *shape) for genome in genomes]
+        batch = NeuralNetworkBatch.from_genomes(genomes, brains)
+        batch_inputs = self._rng.random((count, shape[0]))
+        self._measure('nn.forward[batch]', lambda: batch.forward(batch_inputs), ops=count, unit='brain')
+
+        evolution = Evolution(0)
+        self._measure('evolution.mutate', lambda: evolution.mutate(genomes.copy()), ops=count, unit='brain')
+
+    def bench_math(self):
+        count = 10000
+        rads = self._rng.uniform(-10., 10., count)
+        scalars = rads.tolist()
+        interpolate_default = CacheMath.INTERPOLATE
+        for interpolate in (False, True):
+            CacheMath.set_resolution(CacheMath.RESOLUTION, interpolate)
+            mode = 'interpolated' if interpolate else 'nearest'
+            self._measure(f'cachemath.cos[{mode}]', lambda: [CacheMath.cos(rad) for rad in scalars], ops=count, unit='angle')
+            self._measure(f'cachemath.cos_array[{mode}]', lambda: CacheMath.cos_array(rads), ops=count, unit='angle')
+        CacheMath.set_resolution(CacheMath.RESOLUTION, interpolate_default)
+
+    def bench_map(self):
+        for map_file in self.MAP_FILES:
+            game_map = self._map(map_file)
+            name = os.path.basename(map_file)
+
+            count = 10000
+            points = [Vec(pt) for pt in self._road_points(game_map, count).tolist()]
+            self._measure(f'map.point_is_on_path/{name}',
+                          lambda: [game_map.point_is_on_path(pt) for pt in points], ops=count, unit='point')
+
+            count = 1000
+            points = points[:count]
+            self._measure(f'map.get_path_point/{name}',
+                          lambda: [game_map.get_path_point(pt) for pt in points], ops=count, unit='point')
+
+            count = 10000
+            array_points = self._road_points(game_map, count)
+            self._measure(f'map.get_stonemiles/{name}',
+                          lambda: game_map.get_stonemiles(array_points), ops=count, unit='point')
+
+            self._measure(f'map.__init__[cached]/{name}', lambda: Map(map_file), repeat=3)
+            if not self._quick:
+                cache_dir = Map.CACHE_DIR
+                Map.CACHE_DIR = None
+                try:
+                    self._measure(f'map.__init__[build]/{name}', lambda: Map(map_file), repeat=1)
+                finally:
+                    Map.CACHE_DIR = cache_dir
+
+    def bench_game(self):
+        steps = 20 if self._quick else 60
+        cars_counts = [count for count in self.CARS_COUNTS if not self._quick or count <= 1000]
+        for map_file in self.MAP_FILES:
+            for cars_count in cars_counts:
+                name = f'game.update[{cars_count}]/{os.path.basename(map_file)}'
+                if self._filter is not None and self._filter not in name:
+                    continue
+
+                # The game logs (cars going the wrong way, ...) are not shown
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    game = Game([map_file], None, cars_count, seed=0)
+                    game.update(App.DELTA_TIME)     # Warmup
+
+                    # First steps of the generation only: later ones depend on how many cars are still alive
+                    alive = 0
+                    start = time.perf_counter()
+                    for _ in range(steps):
+                        alive += len(game._population.alive_cars())
+                        game.update(App.DELTA_TIME)
+                    elapsed = time.perf_counter() - start
+
+                self._results[name] = {'time': elapsed / steps, 'unit': 's/step', 'ops': steps,
+                                       'cars_steps_per_sec': alive / elapsed}
+                print(f'{name:<48} {elapsed / steps * 1e3:>14.3f} ms/step ({alive / elapsed:,.0f} cars steps/s)')
+
+    def run(self):
+        # No checkpoint from the benchmarked games
+        Game.CHECKPOINT_EVERY = 0
+
+        for bench in (self.bench_sensors, self.bench_neural_network, self.bench_math, self.bench_map, self.bench_game):
+            bench()
+        return self._results
+
+    @staticmethod
+    def meta():
+        return {
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'numba': numba.__version__,
+            'pygame': pygame.version.ver,
+            'cpu_count': os.cpu_count(),
+        }
+
+    def dump(self, file_name):
+        with open(file_name, 'w') as f:
+            json.dump({'meta': self.meta(), 'results': self._results}, f, indent=2)
+        print(f' - Saved benchmark results to: {file_name}')
+
+    @classmethod
+    def compare(cls, results, baseline_file, threshold=REGRESSION_THRESHOLD):
+        """Prints the ratio of each result to the baseline one, returns the names of the regressions"""
+        with open(baseline_file, 'r') as f:
+            baseline = json.load(f)['results']
+
+        regressions = []
+        print(f'\n{"benchmark":<48} {"baseline":>12} {"current":>12} {"ratio":>8}')
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            ratio = result['time'] / baseline[name]['time']
+            flag = ''
+            if ratio > 1. + threshold:
+                flag = '  << REGRESSION'
+                regressions.append(name)
+            elif ratio < 1. - threshold:
+                flag = '  (faster)'
+            print(f'{name:<48} {baseline[name]["time"]:>12.3e} {result["time"]:>12.3e} {ratio:>8.2f}{flag}')
+
+        print(f'\n{len(regressions)} regression(s) (threshold: +{threshold:.0%})')
+        return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmarks of the simulation hot paths')
+    parser.add_argument('-o', '--output', default=None, help='JSON file to save the results to')
+    parser.add_argument('-c', '--compare', default=None, help='Baseline JSON results to compare to (exit code 1 on regressions)')
+    parser.add_argument('-t', '--threshold', type=float, default=Benchmark.REGRESSION_THRESHOLD, help='Relative slowdown flagged as a regression')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Runs of each micro-benchmark (the best one is kept)')
+    parser.add_argument('-f', '--filter', default=None, help='Only run the benchmarks whose name contains this text')
+    parser.add_argument('--quick', action='store_true', help=f'Skip the slowest benchmarks (map builds, {Benchmark.CARS_COUNTS[-1]} cars)')
+    args = parser.parse_args()
+
+    pygame.init()
+
+    benchmark = Benchmark(quick=args.quick, repeat=args.repeat, filter_name=args.filter)
+    results = benchmark.run()
+
+    if args.output is not None:
+        benchmark.dump(args.output)
+
+    if args.compare is not None and Benchmark.compare(results, args.compare, args.threshold):
+        sys.exit(1)
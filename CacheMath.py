@@ -1,41 +1,84 @@
-
-from numba import jit
 import math
 
+import numpy as np
+
 class CacheMath(object):
-    _RAD = {}
-    _COS = {}
-    _SIN = {}
+    """
+    Sine and cosine looked up in tables preallocated over a full turn, RESOLUTION entries per degree,
+    so the memory stays the same whatever the angles asked (the angles are in radians, like math).
+    The nearest entry is returned, or the linear interpolation of the 2 nearest ones with INTERPOLATE.
+    Only used to draw (the sensors rays): the simulation needs its trigonometry exact, and batches it with numpy and numba.
+    """
 
-    @staticmethod
-    def _get_value(angle, func, cache):
-        if angle not in cache:
-            cache[angle] = func(angle)
-        return cache[angle]
+    RESOLUTION = 10         # Table entries per degree
+    INTERPOLATE = False
 
-    @staticmethod
-    @jit(fastmath=True)
-    def _radians(angle):
-        return math.radians(angle)
+    _COS = None
+    _SIN = None
+    _COS_LIST = None        # Lists for the scalar lookups (indexing a list is faster than a numpy array)
+    _SIN_LIST = None
+    _SCALE = None           # Table index of an angle in radians
+    _COUNT = None
 
-    @staticmethod
-    @jit(fastmath=True)
-    def _cos(angle):
-        return math.cos(angle)
+    @classmethod
+    def set_resolution(cls, resolution=RESOLUTION, interpolate=INTERPOLATE):
+        count = int(round(360 * resolution))
+        assert count > 0
 
-    @staticmethod
-    @jit(fastmath=True)
-    def _sin(angle):
-        return math.sin(angle)
+        cls.RESOLUTION = resolution
+        cls.INTERPOLATE = interpolate
+
+        angles = np.arange(count) * (2 * math.pi / count)
+        cls._COS = np.cos(angles)
+        cls._SIN = np.sin(angles)
+        cls._COS_LIST = cls._COS.tolist()
+        cls._SIN_LIST = cls._SIN.tolist()
+        cls._SCALE = count / (2 * math.pi)
+        cls._COUNT = count
 
     @staticmethod
     def radians(angle):
-        return CacheMath._get_value(angle, CacheMath._radians, CacheMath._RAD)
+        return math.radians(angle)
 
-    @staticmethod
-    def cos(angle):
-        return CacheMath._get_value(angle, CacheMath._cos, CacheMath._COS)
+    @classmethod
+    def _lookup(cls, table, rad):
+        x = rad * cls._SCALE
+        if not cls.INTERPOLATE:
+            return table[round(x) % cls._COUNT]
 
-    @staticmethod
-    def sin(angle):
-        return CacheMath._get_value(angle, CacheMath._sin, CacheMath._SIN)
+        i = math.floor(x)
+        t = x - i
+        i %= cls._COUNT
+        return table[i] + (table[(i + 1) % cls._COUNT] - table[i]) * t
+
+    @classmethod
+    def _lookup_array(cls, table, rads):
+        x = np.asarray(rads, dtype=np.float64) * cls._SCALE
+        if not cls.INTERPOLATE:
+            return table[np.rint(x).astype(np.int64) % cls._COUNT]
+
+        i = np.floor(x)
+        t = x - i
+        i = i.astype(np.int64) % cls._COUNT
+        return table[i] + (table[(i + 1) % cls._COUNT] - table[i]) * t
+
+    @classmethod
+    def cos(cls, rad):
+        return cls._lookup(cls._COS_LIST, rad)
+
+    @classmethod
+    def sin(cls, rad):
+        return cls._lookup(cls._SIN_LIST, rad)
+
+    @classmethod
+    def cos_array(cls, rads):
+        """Cosines of an array of angles (in radians), same shape"""
+        return cls._lookup_array(cls._COS, rads)
+
+    @classmethod
+    def sin_array(cls, rads):
+        """Sines of an array of angles (in radians), same shape"""
+        return cls._lookup_array(cls._SIN, rads)
+
+
+CacheMath.set_resolution()
@@ -2,8 +2,6 @@
 import pygame
 import pygame.gfxdraw
 
-from pygame.math import Vector2 as Vec
-
 import numpy as np
 
 import config
@@ -12,104 +10,7 @@ from Controls import Controls
 
 from Sensors import Sensors
 from CarPhysics import CarPhysics
-from CacheMath import CacheMath
-
-class MyCarPhysics(object):
-
-    ACCELERATION_FORCE = .5
-    BRAKE_FORCE = -2.
-
-    ROTATION_FORCE = 5.
-
-    MAX_ACCELERATION = 5.
-
-    def __init__(self, start_pos, start_heading):
-        self._front_pos = None
-
-        self._start_pos = Vec(start_pos)
-        self._start_heading = start_heading
-
-        self._heading = start_heading
-        self.pos = Vec(start_pos)
-
-        self._old_pos = Vec(self.pos)
-
-        self._steering = 0.
-        self._acceleration = 0.
-        self._vel = Vec()
-
-    def _compute_front_pos(self):
-        rad = CacheMath.radians(-self._heading)
-        self._front_pos = self._pos + (CacheMath.cos(-rad) * Car.CAR_HW, CacheMath.sin(-rad) * Car.CAR_HW)
-
-    @property
-    def pos(self):
-        return self._pos
-
-    @pos.setter
-    def pos(self, value):
-        self._pos = value
-        self._compute_front_pos()
-
-    @property
-    def start_pos(self):
-        return self._start_pos
-
-    @property
-    def heading(self):
-        return self._heading
-
-    @heading.setter
-    def heading(self, value):
-        self._heading = value
-        self._compute_front_pos()
-
-    @property
-    def start_heading(self):
-        return self._start_heading
-
-    @property
-    def acceleration(self):
-        return self._acceleration
-
-    @property
-    def front_pos(self):
-        return self._front_pos
-
-    @staticmethod
-    def _clamp(value, min_value, max_value):
-        return max(min_value, min(value, max_value))
-
-    def move(self, left=False, right=False, accelerate=False, brake=False):
-        if left:
-            self._heading += -self.ROTATION_FORCE
-        if right:
-            self._heading += self.ROTATION_FORCE
-
-        if accelerate:
-            self._acceleration += self.ACCELERATION_FORCE
-        if brake:
-            self._acceleration += self.BRAKE_FORCE
-
-        if self._acceleration < self.ACCELERATION_FORCE:
-            self._acceleration = 0.
-        if self._acceleration > self.MAX_ACCELERATION:
-            self._acceleration = self.MAX_ACCELERATION
-
-        vel = Vec(1, 0).rotate(self._heading)
-        vel *= self._acceleration
-
-        self._old_pos = Vec(self.pos)
-        self.pos += vel
-
-    def update(self, game_map):
-        if not game_map.point_is_on_path(self.front_pos):
-            self._acceleration = 0.
-            self.pos = Vec(self._old_pos)
-            return
-
-        self._acceleration *= .99
-
+from Sprite import RotatedSprite
 
 class Car(Controls):
 
@@ -118,14 +19,29 @@ class Car(Controls):
     }
     __CONTROLS_SUBCLASSES__ = [ Sensors ]
 
-    _img_best = pygame.image.load('imgs/best_car.png')
-    _img_std = pygame.image.load('imgs/car.png')
+    # Loaded with the sprites, at the first draw (see _init_sprites)
+    IMG_BEST = 'imgs/best_car.png'
+    IMG_STD = 'imgs/car.png'
 
     _is_drawing_best_only = False
 
-    CAR_W, CAR_H = _img_std.get_size()
+    CAR_W, CAR_H = 20, 10       # Size of the images
     CAR_HW, CAR_HH = CAR_W / 2, CAR_H / 2
 
+    # Debug indicators of the best car actions, drawn over its image: {action: (color, center in the image)}
+    ACTIONS_INDICATORS = {
+        'brake': ('red', (3, CAR_H // 2)),
+        'decelerate': ('white', (3, CAR_H // 2)),
+        'left': ('yellow', (CAR_W - 1, 1)),
+        'right': ('yellow', (CAR_W - 1, CAR_H - 1)),
+    }
+    ACTIONS_INDICATORS_RADIUS = 3
+
+    # Pre-rotated images, built at the first draw (see _init_sprites)
+    _sprite_best = None
+    _sprite_std = None
+    _sprites_actions = None
+
     def __init__(self, start_pos, start_heading, map_gen, stonemiles_count_max):
         self._map_gen = map_gen
         self._stonemiles_count_max = stonemiles_count_max
@@ -143,6 +59,9 @@ class Car(Controls):
 
         self._is_wrong_way = False
 
+        # Progress along the track centerline: (segment, lap fraction, progress, best progress) (see Map.update_track)
+        self._track = np.zeros(4)
+
         self._cur_actions = {}
 
         self.reset()
@@ -158,10 +77,33 @@ class Car(Controls):
 
         self._is_wrong_way = False
 
+        self._track[:] = (-1, 0., 0., 0.)
+
+    def bind_track(self, track, row):
+        """Use the row of a population track array [cars, 4] (see Population)"""
+        track[row] = self._track
+        self._track = track[row]
+
     @property
     def pos(self):
         return self._body.pos
 
+    @property
+    def body(self):
+        return self._body
+
+    @property
+    def sensors(self):
+        return self._sensors
+
+    @property
+    def brain(self):
+        return None
+
+    @property
+    def actions(self):
+        return self._cur_actions
+
     def dead(self):
         self._is_alive = False
 
@@ -181,6 +123,25 @@ class Car(Controls):
     def laps_count(self):
         return self._laps_count
 
+    @property
+    def stonemiles_count(self):
+        return self._stonemiles_count
+
+    @property
+    def lap_fraction(self):
+        """Position on the lap, from 0 (start) to 1 along the track centerline"""
+        return float(self._track[1])
+
+    @property
+    def progress(self):
+        """Laps driven along the track centerline since the start (negative backwards)"""
+        return float(self._track[2])
+
+    @property
+    def progress_max(self):
+        """Best progress reached so far"""
+        return float(self._track[3])
+
     @classmethod
     def event(cls, event):
         if event.type == pygame.KEYDOWN:
@@ -193,10 +154,6 @@ class Car(Controls):
     def _get_move_actions(self):
         raise NotImplementedError
 
-    def _move(self, delta_time):
-        self._cur_actions = self._get_move_actions()
-        self._body.move(self._cur_actions, delta_time)
-
     def is_lap_end(self):
         if self._old_stonemile == self._stonemiles_count_max - 1 and \
             self._cur_stonemile == 0:
@@ -233,20 +190,32 @@ class Car(Controls):
         self._laps_count += 1
 
     @should_be_alive
-    def update_prolog(self, game_map):
-        self._cur_stonemile = -1
+    def update_stonemile(self, game_map):
+        self._cur_stonemile = game_map.get_stonemile(self._body.front_pos)
 
-        if game_map.point_is_on_path(self._body.front_pos):
-            path_point = game_map.get_path_point(self._body.front_pos)
-            if path_point is not None:
-                _, self._cur_stonemile = path_point
+    @should_be_alive
+    def set_stonemile(self, stonemile):
+        """Replaces update_stonemile() when the stonemiles of the population are looked up at once"""
+        self._cur_stonemile = stonemile
 
+    @should_be_alive
+    def update_track(self, game_map):
+        game_map.update_track(np.array([self._body.front_pos]), self._track.reshape(1, -1))
+
+    @should_be_alive
+    def update_prolog(self, game_map):
+        self.update_stonemile(game_map)
+        self.update_track(game_map)
         self._sensors.update_prolog(game_map)
 
+    @should_be_alive
+    def update_actions(self):
+        self._cur_actions = self._get_move_actions()
+
     @should_be_alive
     def update_move(self, delta_time):
         # Move the car
-        self._move(delta_time)
+        self._body.move(self._cur_actions, delta_time)
 
     @should_be_alive
     def update_detection(self, game_map):
@@ -263,9 +232,12 @@ class Car(Controls):
             getattr(self, detect_func)(game_map)
 
     @should_be_alive
-    def update_epilog(self, game_map, delta_time):
+    def update_body(self, delta_time):
         # Update physics
         self._body.update(delta_time)
+
+    @should_be_alive
+    def update_epilog(self, game_map):
         if not game_map.point_is_on_path(self._body.front_pos):
             self._body.immobilize()
 
@@ -274,35 +246,53 @@ class Car(Controls):
 
         self._old_stonemile = self._cur_stonemile
 
-        self._sensors.update_epilog(game_map)
-
     @should_be_alive
     def update(self, game_map, delta_time):
+        # Standalone update of this car only (see Population.update for the batched one)
         self.update_prolog(game_map)
+        self.update_actions()
         self.update_move(delta_time)
         self.update_detection(game_map)
-        self.update_epilog(game_map, delta_time)
+        self.update_body(delta_time)
+        self.update_epilog(game_map)
+        self._sensors.update_epilog(game_map)
 
-    def draw(self, screen, debug=False):
+    @classmethod
+    def _init_sprites(cls):
+        img_best = pygame.image.load(cls.IMG_BEST)
+        img_std = pygame.image.load(cls.IMG_STD)
+        assert img_best.get_size() == img_std.get_size() == (cls.CAR_W, cls.CAR_H), "Car images of another size than CAR_W, CAR_H"
+
+        cls._sprite_best = RotatedSprite(img_best)
+        cls._sprite_std = RotatedSprite(img_std)
+
+        cls._sprites_actions = {}
+        for action, (color, center) in cls.ACTIONS_INDICATORS.items():
+            img = pygame.Surface((cls.CAR_W, cls.CAR_H), pygame.SRCALPHA)
+            pygame.draw.circle(img, pygame.Color(color), center, cls.ACTIONS_INDICATORS_RADIUS)
+            cls._sprites_actions[action] = RotatedSprite(img)
+
+    def draw(self, screen, debug=False, alpha=1., offset=(0, 0)):
+        """
+        alpha: how far (0 to 1) in its last step the car is drawn
+        offset: map position drawn at the top left of the screen
+        """
         if self.is_dead and \
            not self.is_best:
             return
 
-        img = self._img_best if self.is_best else self._img_std
+        if Car._sprite_std is None:
+            Car._init_sprites()
+
+        pos, heading = self._body.interpolated_pose(alpha)
+        pos -= offset
+
+        sprite = Car._sprite_best if self.is_best else Car._sprite_std
+        sprite.draw(screen, pos, heading)
 
         if debug and self.is_best:
-            img = img.copy()
-            if self._cur_actions.get('brake', False):
-                pygame.draw.circle(img, pygame.Color('red'), (3, img.get_height() // 2), 3)
-            if self._cur_actions.get('decelerate', False):
-                pygame.draw.circle(img, pygame.Color('white'), (3, img.get_height() // 2), 3)
-            if self._cur_actions.get('left', False):
-                pygame.draw.circle(img, pygame.Color('yellow'), (img.get_width() - 1, 1), 3)
-            if self._cur_actions.get('right', False):
-                pygame.draw.circle(img, pygame.Color('yellow'), (img.get_width() - 1, img.get_height() - 1), 3)
-
-        img = pygame.transform.rotate(img, -self._body.heading).convert_alpha()
-        rect = img.get_rect(center=self._body.pos)
-        screen.blit(img, rect)
-
-        self._sensors.draw(screen, debug)
+            for action, sprite in Car._sprites_actions.items():
+                if self._cur_actions.get(action, False):
+                    sprite.draw(screen, pos, heading)
+
+        self._sensors.draw(screen, debug, offset)
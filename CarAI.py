@@ -8,17 +8,25 @@ import numpy as np
 import config
 
 from Neuron import NeuralNetwork as NN
+from CarPhysics import CarPhysics, PopulationPhysics
 
 from Car import Car
+from Map import Map
+from Sensors import Sensors
 
 class CarAI(Car):
 
     Car.__CONTROLS_SUBCLASSES__.append(NN)
 
+    HIDDEN_COUNT = 20
+
     MAX_LIFE_COUNT_START = 50
     MAX_LIFE_COUNT_INC = 25
     LIFE_COUNT_CONSUMPTION_BASE = .5
 
+    # Brain outputs order
+    OUTPUTS_ACTIONS = ['left', 'right', 'accelerate', 'brake']
+
     FITNESS_PARTS = [
         '_fitness_dist',
         '_fitness_stonemiles',
@@ -31,11 +39,12 @@ class CarAI(Car):
         self._brain = None
 
         if init_brain:
-            input_length = self._sensors.count + 1    # +1 for self._acceleration
-            self._brain = NN(input_count=input_length,
-                             hidden_count=20,
-                             output_count=4,    # Left, Right, Accel, Brake
-            )
+            self._brain = NN(*self.brain_shape())
+
+    @classmethod
+    def brain_shape(cls):
+        input_length = Sensors.sensors_count() + 1    # +1 for self._acceleration
+        return (input_length, cls.HIDDEN_COUNT, len(cls.OUTPUTS_ACTIONS))
 
     def reset(self):
         super().reset()
@@ -45,6 +54,10 @@ class CarAI(Car):
         self._max_dist = 0
         self._kill_counter = 10
 
+    @property
+    def brain(self):
+        return self._brain
+
     def clone(self, map_gen, stonemiles_count_max):
         clone = self.__class__(self._body.start_pos, self._body.start_heading, map_gen, stonemiles_count_max, init_brain=False)
         clone._brain = self._brain.copy()
@@ -53,6 +66,13 @@ class CarAI(Car):
     def dump(self, fname):
         self._brain.dump(fname)
 
+    @staticmethod
+    def from_genome(start_pos, start_heading, map_gen, stonemiles_count_max, genome):
+        """The brain weights are a view of `genome` (see NeuralNetwork.to_genome)"""
+        car = CarAI(start_pos, start_heading, map_gen, stonemiles_count_max, init_brain=False)
+        car._brain = NN.from_genome(genome, *CarAI.brain_shape())
+        return car
+
     @staticmethod
     def load(start_pos, start_heading, map_gen, stonemiles_count_max, fname):
         car = CarAI(start_pos, start_heading, map_gen, stonemiles_count_max, init_brain=False)
@@ -63,31 +83,79 @@ class CarAI(Car):
         details = ' + '.join([f'{getattr(self, part):.3}' for part in self.FITNESS_PARTS])
         return f'fitness {self.fitness:.3} ({details})'
 
+    FITNESS_DIST_COEF = .01
+    FITNESS_STONEMILES_COEF = 1.
+    FITNESS_LAPS_COEF = 1000.
+
+    # Stonemiles part of the fitness from the best progress along the track (in stonemiles, see Car.progress_max)
+    # instead of the count of stonemiles reached: it grows continuously between 2 stonemiles
+    FITNESS_PROGRESS = False
+
     @property
     def _fitness_dist(self):
-        coef = .01
-        return self._max_dist * coef
+        return self._max_dist * self.FITNESS_DIST_COEF
+
+    @property
+    def _stonemiles_progress(self):
+        if self.FITNESS_PROGRESS:
+            return self.progress_max * self._stonemiles_count_max
+        return self._stonemiles_count
 
     @property
     def _fitness_stonemiles(self):
-        coef = 1.
-        return self._stonemiles_count * coef
+        return self._stonemiles_progress * self.FITNESS_STONEMILES_COEF
 
     @property
     def _fitness_laps(self):
-        coef = 1000.
-        return self._laps_count * coef
+        return self._laps_count * self.FITNESS_LAPS_COEF
+
+    STATS_COUNT = 4
+
+    @property
+    def stats(self):
+        """What the fitness is computed from (see set_stats)"""
+        return (self._max_dist, self._stonemiles_count, self._laps_count, self.progress_max)
+
+    def set_stats(self, stats):
+        """Set the result of a car evaluated elsewhere (see Evaluator), the best progress is optional"""
+        max_dist, stonemiles_count, laps_count, *progress_max = stats
+        self._max_dist = float(max_dist)
+        self._stonemiles_count = int(stonemiles_count)
+        self._laps_count = int(laps_count)
+        self._track[3] = progress_max[0] if progress_max else 0.
 
     @property
     def fitness(self):
         return sum(getattr(self, part) for part in self.FITNESS_PARTS)
 
+    def fitness_bound(self, steps, delta_time, game_map, laps_max):
+        """
+        Fitness this car can not exceed after `steps` more steps (the generation ends after `laps_max` laps):
+        at most one stonemile (or as much progress, see FITNESS_PROGRESS) and the maximum acceleration per step,
+        and new laps only if the last stonemile is within reach at full acceleration
+        """
+        acceleration_max = CarPhysics.MAX_ACCELERATION * delta_time
+        max_dist = self._max_dist + steps * acceleration_max
+
+        speeds = np.minimum(abs(self._body.velocity) + acceleration_max * np.arange(1, steps + 1), CarPhysics.MAX_VELOCITY)
+        reach = speeds.sum() + Map.PATH_RADIUS + CarPhysics.WIDTH
+        laps_count = self._laps_count
+        if self._body.front_pos.distance_to(game_map.stonemiles[-1]) <= reach:
+            laps_count = max(laps_count, laps_max + 1)
+
+        stonemiles_count = self._stonemiles_progress + steps + (laps_count - self._laps_count)
+        return (max_dist * self.FITNESS_DIST_COEF +
+                stonemiles_count * self.FITNESS_STONEMILES_COEF +
+                laps_count * self.FITNESS_LAPS_COEF)
+
     @property
     def life_count_consumption(self):
         return self.LIFE_COUNT_CONSUMPTION_BASE * (self._map_gen + 1)
 
-    def mutate(self):
-        self._brain.mutate(.1, .7)
+    @property
+    def life_steps(self):
+        """Steps this car lives at most without reaching a new stonemile"""
+        return int(max(self._max_life_count, 0.) // self.life_count_consumption) + 1
 
     @classmethod
     def event(cls, event):
@@ -95,32 +163,46 @@ class CarAI(Car):
 
         NN.event(event)
 
+    def get_brain_inputs(self):
+        return self._sensors.get_all_sensors_length() + [self._body.acceleration]
+
+    @classmethod
+    def outputs_to_actions(cls, outputs):
+        return {action: outputs[i] > 0 for i, action in enumerate(cls.OUTPUTS_ACTIONS)}
+
+    @classmethod
+    def outputs_to_physics_actions(cls, outputs):
+        """Brain outputs of many cars [cars, outputs] to PopulationPhysics actions [cars, actions]"""
+        actions = np.zeros((len(outputs), len(PopulationPhysics.ACTIONS)), dtype=bool)
+        for i, action in enumerate(cls.OUTPUTS_ACTIONS):
+            actions[:, PopulationPhysics.ACTIONS.index(action)] = outputs[:, i] > 0
+        return actions
+
     def _get_move_actions(self):
-        inputs = np.array(self._sensors.get_all_sensors_length() + [self._body._acceleration])
+        inputs = np.array(self.get_brain_inputs())
         outputs = self._brain.forward(inputs)
-        actions = {
-            'left': outputs[0] > 0,
-            'right': outputs[1] > 0,
-            'accelerate': outputs[2] > 0,
-            'brake': outputs[3] > 0,
-        }
 
         #print(f'L/R:{outputs[0]:.3f} | U/D:{outputs[1]:.3f}')
 
-        return actions
+        return self.outputs_to_actions(outputs)
+
+    @Car.should_be_alive
+    def set_brain_outputs(self, outputs):
+        """Replaces update_actions() when the brains of the population are evaluated at once"""
+        self._cur_actions = self.outputs_to_actions(outputs)
 
     def update_detection(self, game_map):
         super().update_detection(game_map)
 
         #//TEMP revoir si le kill_counter est toujours utile...
-        if self._body._acceleration == 0.:
+        if self._body.acceleration == 0.:
             self._kill_counter -= 1
 
         if self._kill_counter <= 0:
             #print(f'kill counter <= 0')
             self.dead()
 
-        self._max_dist += self._body._acceleration
+        self._max_dist += self._body.acceleration
 
         self._max_life_count -= self.life_count_consumption
 
@@ -137,6 +219,6 @@ class CarAI(Car):
 
         self._brain.draw(screen, debug=debug)
 
-    def draw(self, screen, debug=False):
-        super().draw(screen, debug)
+    def draw(self, screen, debug=False, alpha=1., offset=(0, 0)):
+        super().draw(screen, debug, alpha, offset)
         self._draw_brain(screen, debug)
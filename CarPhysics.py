@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 
-import pygame
-from pygame.math import Vector2 as Vec
+import numpy as np
 
-from math import sin, radians, degrees, copysign
-from CacheMath import CacheMath
+from pygame.math import Vector2 as Vec
 
 
 class CarPhysics(object):
+    """
+    Physics of one car, as a view over one row of a PopulationPhysics.
+    A standalone car owns a population of 1 until it is bound to a bigger one.
+    """
+
     IRL_CAR_LONG = 4        # in meters
     IRL_CAR_LARGE = 2       # in meters
 
@@ -31,127 +34,210 @@ class CarPhysics(object):
     FREE_DECELERATION_SPEED = ACCELERATION_SPEED / 2
 
     def __init__(self, start_pos: Vec, start_heading: float):
-        self._front_pos = None
-        self._old_pos = None
+        self._population = PopulationPhysics(1)
+        self._index = 0
+        self._indices = np.array([0])
 
-        self._start_pos = Vec(start_pos)
-        self._start_heading = start_heading
+        self._population.reset(self._indices, start_pos, start_heading)
 
-        self._heading = start_heading
-        self.pos = Vec(start_pos)
+    def bind(self, population, index):
+        population.copy_row(index, self._population, self._index)
 
-        self._steering = 0.
-        self._acceleration = 0.
-        self._velocity = Vec(0., 0.)
+        self._population = population
+        self._index = index
+        self._indices = np.array([index])
 
-    def _compute_front_pos(self):
-        rad = CacheMath.radians(-self._heading)
-        self._front_pos = self._pos + (CacheMath.cos(-rad) * self.HALF_WIDTH, CacheMath.sin(-rad) * self.HALF_HEIGHT)
+    @property
+    def index(self):
+        return self._index
 
     @property
     def pos(self):
-        return self._pos
+        return Vec(self._population.pos[self._index].tolist())
 
     @pos.setter
     def pos(self, value):
-        old_pos = getattr(self, '_pos', None)
-
-        self._pos = value
-        self._compute_front_pos()
-
-        self._old_pos = Vec(old_pos) if old_pos is not None else Vec(self._pos)
+        self._population.set_pos(self._indices, value)
 
     @property
     def start_pos(self):
-        return self._start_pos
+        return Vec(self._population.start_pos[self._index].tolist())
 
     @property
     def heading(self):
-        return self._heading
+        return self._population.heading[self._index].item()
 
     @heading.setter
     def heading(self, value):
-        self._heading = value
-        self._compute_front_pos()
+        self._population.set_heading(self._indices, value)
 
     @property
     def start_heading(self):
-        return self._start_heading
+        return self._population.start_heading[self._index].item()
 
     @property
     def acceleration(self):
-        return self._acceleration
+        return self._population.acceleration[self._index].item()
+
+    @property
+    def velocity(self):
+        return self._population.velocity[self._index].item()
 
     @property
     def front_pos(self):
-        return self._front_pos
+        return Vec(self._population.front_pos[self._index].tolist())
 
-    @staticmethod
-    def _clamp(value, min_value, max_value):
-        return max(min_value, min(value, max_value))
+    def interpolated_pose(self, alpha):
+        pos, heading = self._population.interpolated_pose(self._index, alpha)
+        return Vec(pos), heading
 
     def immobilize(self):
-        self._acceleration = 0.
-        self._velocity *= 0.
-        self.pos = Vec(self._old_pos)
-
-    def _move_steering(self, moves: dict, delta_time: float):
-        if moves.get('right', False):
-            self._steering -= self.STEERING_SPEED
-        elif moves.get('left', False):
-            self._steering += self.STEERING_SPEED
-        else:
-            self._steering = 0.0
-
-        clamp_value = self.MAX_STEERING * delta_time
-        self._steering = self._clamp(self._steering * delta_time, -clamp_value, clamp_value)
-
-    def _move_acceleration(self, moves: dict, delta_time: float):
-        def _brake():
-            if abs(self._velocity.x) > delta_time * self.BRAKE_DECELERATION_SPEED:
-                self._acceleration = -copysign(self.BRAKE_DECELERATION_SPEED, self._velocity.x)
-            else:
-                self._acceleration = -self._velocity.x / delta_time
-
-        if moves.get('accelerate', False):
-            if self._velocity.x < 0.0:
-                _brake()
-            else:
-                self._acceleration += self.ACCELERATION_SPEED
-        elif moves.get('decelerate', False):
-            if self._velocity.x > 0.0:
-                _brake()
-            else:
-                self._acceleration -= self.ACCELERATION_SPEED
-        elif moves.get('brake', False):
-            _brake()
-        else:
-            if abs(self._velocity.x) > delta_time * self.FREE_DECELERATION_SPEED:
-                self._acceleration = -copysign(self.FREE_DECELERATION_SPEED, self._velocity.x)
-            else:
-                self._acceleration = -self._velocity.x / delta_time
-
-        clamp_value = self.MAX_ACCELERATION * delta_time
-        self._acceleration = self._clamp(self._acceleration * delta_time, -clamp_value, clamp_value)
+        self._population.immobilize(self._indices)
 
     def move(self, moves: dict, delta_time: float):
-        self._move_steering(moves, delta_time)
-        self._move_acceleration(moves, delta_time)
+        actions = np.array([[moves.get(action, False) for action in PopulationPhysics.ACTIONS]], dtype=bool)
+        self._population.move(actions, delta_time, self._indices)
 
     def update(self, delta_time):
-        # self._velocity += (self._acceleration * delta_time, 0)
-        self._velocity += (self._acceleration, 0)
-        # print(f'velocity: {self._velocity}')
-
-        self._velocity.x = self._clamp(self._velocity.x, -self.MAX_VELOCITY, self.MAX_VELOCITY)
+        self._population.store_previous_pose(self._indices)
+        self._population.update(delta_time, self._indices)
+
+
+class PopulationPhysics(object):
+    """
+    Physics of a whole population of cars, stored as a structure of arrays (one row per car)
+    and advanced with vectorized steps. Same model as the historical per-car CarPhysics.
+    """
+
+    ACTIONS = ('left', 'right', 'accelerate', 'decelerate', 'brake')
+
+    _FIELDS = ('pos', 'front_pos', 'start_pos', 'previous_pos',
+               'heading', 'start_heading', 'previous_heading', 'steering', 'acceleration', 'velocity')
+
+    def __init__(self, count):
+        self.pos = np.zeros((count, 2))
+        self.front_pos = np.zeros((count, 2))
+        self.start_pos = np.zeros((count, 2))
+
+        self.heading = np.zeros(count)
+        self.start_heading = np.zeros(count)
+        self.steering = np.zeros(count)
+        self.acceleration = np.zeros(count)
+        self.velocity = np.zeros(count)     # Longitudinal velocity only (lateral one is always 0)
+
+        # Pose before the last step, to draw the cars between 2 steps (see interpolated_pose)
+        self.previous_pos = np.zeros((count, 2))
+        self.previous_heading = np.zeros(count)
+
+    def __len__(self):
+        return len(self.heading)
+
+    @classmethod
+    def bind(cls, bodies):
+        population = cls(len(bodies))
+        for index, body in enumerate(bodies):
+            body.bind(population, index)
+        return population
+
+    def copy_row(self, index, other, other_index):
+        for field in self._FIELDS:
+            getattr(self, field)[index] = getattr(other, field)[other_index]
+
+    def reset(self, indices, start_pos, start_heading):
+        self.start_pos[indices] = start_pos
+        self.start_heading[indices] = start_heading
+
+        self.heading[indices] = start_heading
+        self.pos[indices] = start_pos
+        self._compute_front_pos(indices)
+        self.store_previous_pose(indices)
+
+        self.steering[indices] = 0.
+        self.acceleration[indices] = 0.
+        self.velocity[indices] = 0.
+
+    def _compute_front_pos(self, indices):
+        rad = np.radians(self.heading[indices])
+        self.front_pos[indices] = self.pos[indices] + np.column_stack((np.cos(rad) * CarPhysics.HALF_WIDTH,
+                                                                       np.sin(rad) * CarPhysics.HALF_HEIGHT))
+
+    def store_previous_pose(self, indices=slice(None)):
+        self.previous_pos[indices] = self.pos[indices]
+        self.previous_heading[indices] = self.heading[indices]
+
+    def interpolated_pose(self, index, alpha):
+        """(pos, heading) of a car at `alpha` (0 to 1) of its last step"""
+        pos = self.previous_pos[index] + alpha * (self.pos[index] - self.previous_pos[index])
+        heading = self.previous_heading[index] + alpha * (self.heading[index] - self.previous_heading[index])
+        return pos.tolist(), heading.item()
+
+    def set_pos(self, indices, value):
+        self.pos[indices] = value
+        self._compute_front_pos(indices)
+
+    def set_heading(self, indices, value):
+        self.heading[indices] = value
+        self._compute_front_pos(indices)
+
+    def immobilize(self, indices):
+        # The per-car model updated its position vector in place, so its "old position" was always
+        # the current one and immobilizing only stopped the car: kept as is for existing brains
+        self.acceleration[indices] = 0.
+        self.velocity[indices] *= 0.
+
+    def _move_steering(self, indices, left, right, delta_time):
+        steering = np.where(right, self.steering[indices] - CarPhysics.STEERING_SPEED,
+                            np.where(left, self.steering[indices] + CarPhysics.STEERING_SPEED, 0.))
+
+        clamp_value = CarPhysics.MAX_STEERING * delta_time
+        self.steering[indices] = np.clip(steering * delta_time, -clamp_value, clamp_value)
 
-        if self._steering != 0.0:
-            turning_radius = self.IRL_CAR_LONG / sin(radians(self._steering))
-            angular_velocity = self._velocity.x / turning_radius
-        else:
-            angular_velocity = 0.0
-
-        self.heading -= degrees(angular_velocity) #* delta_time
-        self.pos += self._velocity.rotate(self.heading) #* delta_time
-
-        # print(f'pos: {self.pos}, heading: {self.heading}')
+    @staticmethod
+    def _deceleration(velocity, speed, delta_time):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(np.abs(velocity) > delta_time * speed,
+                            -np.copysign(speed, velocity),
+                            -velocity / delta_time)
+
+    def _move_acceleration(self, indices, accelerate, decelerate, brake, delta_time):
+        velocity = self.velocity[indices]
+        acceleration = self.acceleration[indices]
+
+        brake_acceleration = self._deceleration(velocity, CarPhysics.BRAKE_DECELERATION_SPEED, delta_time)
+        free_acceleration = self._deceleration(velocity, CarPhysics.FREE_DECELERATION_SPEED, delta_time)
+
+        # Actions priority: accelerate > decelerate > brake > none (free deceleration)
+        acceleration = np.select(
+            [accelerate & (velocity < 0.), accelerate,
+             decelerate & (velocity > 0.), decelerate,
+             brake],
+            [brake_acceleration, acceleration + CarPhysics.ACCELERATION_SPEED,
+             brake_acceleration, acceleration - CarPhysics.ACCELERATION_SPEED,
+             brake_acceleration],
+            default=free_acceleration)
+
+        clamp_value = CarPhysics.MAX_ACCELERATION * delta_time
+        self.acceleration[indices] = np.clip(acceleration * delta_time, -clamp_value, clamp_value)
+
+    def move(self, actions, delta_time, indices=slice(None)):
+        """actions: boolean array [cars, len(ACTIONS)]"""
+        left, right, accelerate, decelerate, brake = np.asarray(actions, dtype=bool).T
+
+        self._move_steering(indices, left, right, delta_time)
+        self._move_acceleration(indices, accelerate, decelerate, brake, delta_time)
+
+    def update(self, delta_time, indices=slice(None)):
+        velocity = self.velocity[indices] + self.acceleration[indices]
+        velocity = np.clip(velocity, -CarPhysics.MAX_VELOCITY, CarPhysics.MAX_VELOCITY)
+        self.velocity[indices] = velocity
+
+        steering = self.steering[indices]
+        with np.errstate(divide='ignore'):
+            turning_radius = CarPhysics.IRL_CAR_LONG / np.sin(np.radians(steering))
+        angular_velocity = np.where(steering != 0., velocity / turning_radius, 0.)
+
+        heading = self.heading[indices] - np.degrees(angular_velocity)
+        self.heading[indices] = heading
+
+        rad = np.radians(heading)
+        self.set_pos(indices, self.pos[indices] + velocity[:, None] * np.column_stack((np.cos(rad), np.sin(rad))))
@@ -0,0 +1,312 @@
+import time
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from pygame.math import Vector2 as Vec
+
+from CarAI import CarAI
+from Map import Map
+from Population import Population
+from Sensors import Sensors
+from Termination import Termination
+
+
+class Shard(object):
+    """
+    Cars of a part of a generation (all of it with 1 worker), stepped one step at a time by run_shards,
+    in this process or in a worker process (see WorkerShard, which has the same methods)
+    """
+
+    def __init__(self, game_map, genomes, map_gen, delta_time, laps_max):
+        start_pos = Vec(game_map.start_pos)
+        self._cars = [CarAI.from_genome(start_pos, game_map.start_heading, map_gen, game_map.stonemiles_count, genome)
+                      for genome in genomes]
+        self._population = Population(self._cars, genomes)
+        self._termination = Termination(self._cars, game_map, delta_time, laps_max)
+        self._map = game_map
+        self._delta_time = delta_time
+        self._laps_max = laps_max
+        self._reply = None
+
+    def step(self):
+        """
+        Steps the alive cars, returns the observation of their Termination (see Termination.observe)
+        and whether an alive car ended more than laps_max laps
+        """
+        self._population.update(self._map, self._delta_time)
+        observation = self._termination.observe()
+        return observation, any(car.laps_count > self._laps_max for car in self._population.alive_cars())
+
+    def fitness(self):
+        return self._termination.fitness()
+
+    def can_beat(self, best_fitness, steps_left):
+        return self._termination.can_beat(best_fitness, steps_left)
+
+    def stop(self):
+        return self._termination.stop()
+
+    def best(self):
+        """(fitness, laps count) of the best car"""
+        best = max(self._cars, key=lambda car: car.fitness)
+        return best.fitness, best.laps_count
+
+    def stats(self):
+        """Stats of each car [cars, CarAI.STATS_COUNT] (see CarAI.stats)"""
+        return np.array([car.stats for car in self._cars], dtype=np.float64).reshape(len(self._cars), CarAI.STATS_COUNT)
+
+    def request(self, method, *args):
+        """Calls a method, its result being returned by reply() (so the worker shards run at the same time)"""
+        self._reply = getattr(self, method)(*args)
+
+    def reply(self):
+        return self._reply
+
+
+def run_shards(shards, delta_time, laps_max, best_fitness=0.):
+    """
+    Steps the shards of a generation in lockstep until all of their cars are dead, a Termination policy fires
+    or the best car ends more than `laps_max` laps (like Game.update, which then goes to the next map).
+    These are decided over all the shards after each step, so the generation ends the same whatever the shards.
+    Returns the count of steps and the result of the Termination of the generation (see Termination.result).
+    """
+    termination = Termination([], None, delta_time, laps_max, best_fitness)
+
+    steps = 0
+    observations = [(False, 1)] * len(shards)
+    while True:
+        stepped = [shard for shard, (_, alive_count) in zip(shards, observations) if alive_count > 0]
+        if not stepped:
+            break
+        for shard in stepped:
+            shard.request('step')
+
+        beyond_laps = False
+        observations = []
+        for shard in shards:
+            if shard in stepped:
+                observation, shard_beyond_laps = shard.reply()
+                beyond_laps |= shard_beyond_laps
+            else:
+                observation = (False, 0)
+            observations.append(observation)
+
+        steps += 1
+
+        if termination.update(observations, shards):
+            break
+
+        # Only a car beyond laps_max can be a best car beyond it (the fitness of the dead cars does not change),
+        # the first best car of the first shard being the first one of the generation
+        if beyond_laps and max((shard.best() for shard in shards), key=lambda best: best[0])[1] > laps_max:
+            break
+
+    return steps, termination.result
+
+
+def evaluate_genomes(game_map, genomes, map_gen, delta_time, laps_max, best_fitness=0.):
+    """
+    Runs the cars of the brains `genomes` [cars, params_count] in this process (see run_shards).
+    Returns the stats of each car [cars, CarAI.STATS_COUNT] (see CarAI.stats), the count of steps
+    and the result of the Termination of the generation (see Termination.result).
+    """
+    shard = Shard(game_map, genomes, map_gen, delta_time, laps_max)
+    steps, termination = run_shards([shard], delta_time, laps_max, best_fitness)
+    return shard.stats(), steps, termination
+
+
+class SharedMap(object):
+    """
+    Simulation arrays of a Map copied once in shared memory,
+    so worker processes attach them instead of receiving a pickled copy.
+    """
+
+    ARRAYS = ('mask_array', 'distance_array', 'stonemiles_array')
+
+    def __init__(self, game_map):
+        self._blocks = []
+
+        arrays = {}
+        try:
+            for name in self.ARRAYS:
+                array = getattr(game_map, name)
+                block = SharedMemory(create=True, size=max(array.nbytes, 1))
+                self._blocks.append(block)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+                arrays[name] = (block.name, array.shape, array.dtype.str)
+        except:
+            self.close()
+            raise
+
+        self._descriptor = {
+            'arrays': arrays,
+            'stonemiles': np.array([(pt.x, pt.y) for pt in game_map.stonemiles]),
+            'centerline': game_map.centerline,
+            'start_pos': game_map.start_pos,
+            'start_heading': game_map.start_heading,
+        }
+
+    @property
+    def descriptor(self):
+        """What a worker needs to attach the map (see attach), small enough to be sent with each task"""
+        return self._descriptor
+
+    @staticmethod
+    def attach(descriptor):
+        """Returns the Map and the shared memory blocks its arrays are backed by (to keep them open)"""
+        blocks = []
+        arrays = {}
+        for name, (block_name, shape, dtype) in descriptor['arrays'].items():
+            block = SharedMemory(name=block_name)
+            blocks.append(block)
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+        game_map = Map.from_arrays(stonemiles=descriptor['stonemiles'],
+                                   start_pos=descriptor['start_pos'],
+                                   start_heading=descriptor['start_heading'],
+                                   centerline=descriptor['centerline'],
+                                   **arrays)
+        return game_map, blocks
+
+    def close(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+
+class WorkerShard(object):
+    """Shard of a worker process, with the methods of Shard (see Worker.run)"""
+
+    def __init__(self, context, settings, map_descriptor):
+        # Imported when the first worker starts, only by the forkserver (see Worker.preload)
+        from Worker import Worker
+
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(target=Worker.run, args=(child_conn, settings, map_descriptor, time.time()),
+                                        daemon=True)
+        self._process.start()
+        child_conn.close()
+
+    def request(self, method, *args):
+        self._conn.send((method, args))
+
+    def reply(self):
+        ok, result = self._conn.recv()
+        if not ok:
+            raise RuntimeError(f'Worker process {self._process.pid} failed:\n{result}')
+        return result
+
+    def _call(self, method, *args):
+        self.request(method, *args)
+        return self.reply()
+
+    def fitness(self):
+        return self._call('fitness')
+
+    def can_beat(self, best_fitness, steps_left):
+        return self._call('can_beat', best_fitness, steps_left)
+
+    def stop(self):
+        return self._call('stop')
+
+    def best(self):
+        return self._call('best')
+
+    def stats(self):
+        return self._call('stats')
+
+    def close(self):
+        try:
+            self._conn.send(None)
+        except OSError:
+            pass
+        self._process.join()
+        self._conn.close()
+
+
+class Evaluator(object):
+    """
+    Evaluates whole generations to completion. With more than one worker, the generation
+    is split into shards evaluated by worker processes, stepped in lockstep: the end of the generation is decided
+    over all the shards after each step, so the results are the same whatever the workers count.
+    When the sensors see the other cars, the cars interact: the whole generation is evaluated by this process.
+    """
+
+    def __init__(self, workers=1):
+        self._workers = max(int(workers), 1)
+        if self._workers > 1 and Sensors.sensing_cars():
+            print(f'The sensors see the other cars: 1 worker instead of {self._workers}')
+            self._workers = 1
+
+        self._worker_shards = None
+        self._map = None
+        self._shared_map = None
+
+    @property
+    def workers(self):
+        return self._workers
+
+    def _get_worker_shards(self, map_descriptor):
+        """map_descriptor: SharedMap the workers warm up their kernels on"""
+        if self._worker_shards is None:
+            # Forked from a server which did not start the numba threads (they are not fork safe), which imports
+            # the Worker module and its kernels once (see Worker.preload), or spawned where it is not available
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(['Worker'])
+            else:
+                context = multiprocessing.get_context('spawn')
+            settings = (Sensors.sensors_angles(), Sensors.raycasting_mode(), CarAI.FITNESS_PROGRESS,
+                        Termination.settings())
+            self._worker_shards = []
+            for _ in range(self._workers):
+                self._worker_shards.append(WorkerShard(context, settings, map_descriptor))
+        return self._worker_shards
+
+    def start(self, game_map):
+        """Starts the workers before the first evaluation, so they start up while this process does (see Startup)"""
+        if self._workers > 1:
+            self._get_worker_shards(self._get_shared_map(game_map).descriptor)
+
+    def _get_shared_map(self, game_map):
+        if game_map is not self._map:
+            if self._shared_map is not None:
+                self._shared_map.close()
+            self._map = game_map
+            self._shared_map = SharedMap(game_map)
+        return self._shared_map
+
+    def evaluate(self, game_map, genomes, map_gen, delta_time, laps_max, best_fitness=0.):
+        """Same as evaluate_genomes()"""
+        if self._workers == 1:
+            return evaluate_genomes(game_map, genomes, map_gen, delta_time, laps_max, best_fitness)
+
+        descriptor = self._get_shared_map(game_map).descriptor
+        shards = []
+        for shard, shard_genomes in zip(self._get_worker_shards(descriptor), np.array_split(genomes, self._workers)):
+            if len(shard_genomes) > 0:
+                shard.request('start', descriptor, shard_genomes, map_gen, delta_time, laps_max)
+                shards.append(shard)
+        for shard in shards:
+            shard.reply()
+
+        steps, termination = run_shards(shards, delta_time, laps_max, best_fitness)
+
+        for shard in shards:
+            shard.request('stats')
+        stats = np.concatenate([shard.reply() for shard in shards])
+        return stats, steps, termination
+
+    def close(self):
+        if self._worker_shards is not None:
+            for shard in self._worker_shards:
+                shard.close()
+            self._worker_shards = None
+
+        if self._shared_map is not None:
+            self._shared_map.close()
+            self._shared_map = None
+        self._map = None
@@ -0,0 +1,98 @@
+import numpy as np
+
+
+class Evolution(object):
+    """
+    Genetic operators applied to a whole generation at once.
+    A generation is a flat genome matrix [pop, n_params] (see NeuralNetwork.to_genome),
+    and every random draw comes from one seeded numpy Generator so runs can be replayed.
+    """
+
+    MUTATION_RATE = .1
+    MUTATION_SCALE = .7
+
+    # 'best': every child comes from the best genome (historical behaviour)
+    SELECTIONS = ['best', 'tournament', 'rank']
+    SELECTION = SELECTIONS[0]
+    TOURNAMENT_SIZE = 3
+
+    CROSSOVERS = ['none', 'uniform', 'arithmetic']
+    CROSSOVER = CROSSOVERS[0]
+
+    ELITISM = 0     # Count of best genomes copied unchanged to the next generation
+
+    def __init__(self, seed=None):
+        self._seed = seed
+        self._rng = np.random.default_rng(seed)
+
+    @property
+    def seed(self):
+        return self._seed
+
+    @property
+    def rng(self):
+        return self._rng
+
+    def random_genomes(self, pop_count, params_count):
+        return self._rng.uniform(-1, 1, (pop_count, params_count))
+
+    def mutate(self, genomes, rate=MUTATION_RATE, scale=MUTATION_SCALE):
+        """
+        Mutates in place each gene with a probability of `rate`,
+        by adding a gaussian noise of standard deviation `scale`
+        """
+        mask = self._rng.random(genomes.shape) < rate
+        genomes[mask] += self._rng.standard_normal(np.count_nonzero(mask)) * scale
+        return genomes
+
+    @staticmethod
+    def select_best(fitness, count):
+        return np.full(count, np.argmax(fitness))
+
+    def select_tournament(self, fitness, count, size=TOURNAMENT_SIZE):
+        """Each parent is the fittest of `size` genomes drawn at random"""
+        contenders = self._rng.integers(0, len(fitness), (count, size))
+        return contenders[np.arange(count), np.argmax(fitness[contenders], axis=1)]
+
+    def select_rank(self, fitness, count):
+        """Parents drawn with a probability proportional to their fitness rank (worst is 1)"""
+        ranks = np.empty(len(fitness))
+        ranks[np.argsort(fitness, kind='stable')] = np.arange(1, len(fitness) + 1)
+        return self._rng.choice(len(fitness), count, p=ranks / ranks.sum())
+
+    def select(self, fitness, count):
+        """Indices of `count` parents"""
+        if self.SELECTION == 'tournament':
+            return self.select_tournament(fitness, count, self.TOURNAMENT_SIZE)
+        if self.SELECTION == 'rank':
+            return self.select_rank(fitness, count)
+        return self.select_best(fitness, count)
+
+    def crossover_uniform(self, parents_a, parents_b):
+        """Each gene comes from one parent or the other"""
+        return np.where(self._rng.random(parents_a.shape) < .5, parents_a, parents_b)
+
+    def crossover_arithmetic(self, parents_a, parents_b):
+        """Each child is a random blend of its parents"""
+        alpha = self._rng.random((len(parents_a), 1))
+        return alpha * parents_a + (1. - alpha) * parents_b
+
+    def next_generation(self, genomes, fitness, pop_count):
+        """
+        New genome matrix [pop_count, n_params] bred from `genomes` [n, n_params] and their `fitness` [n]:
+        the ELITISM best genomes first, then the mutated children of the selected parents
+        """
+        fitness = np.asarray(fitness, dtype=np.float64)
+
+        elites_count = min(self.ELITISM, pop_count)
+        elites = genomes[np.argsort(-fitness, kind='stable')[:elites_count]]
+
+        children_count = pop_count - elites_count
+        children = genomes[self.select(fitness, children_count)]
+        if self.CROSSOVER == 'uniform':
+            children = self.crossover_uniform(children, genomes[self.select(fitness, children_count)])
+        elif self.CROSSOVER == 'arithmetic':
+            children = self.crossover_arithmetic(children, genomes[self.select(fitness, children_count)])
+        self.mutate(children, self.MUTATION_RATE, self.MUTATION_SCALE)
+
+        return np.concatenate((elites, children))
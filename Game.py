@@ -1,22 +1,43 @@
 
+import os
+import json
+import random
+
 import pygame
 from pygame.math import Vector2 as Vec
 
+import numpy as np
+
 import config
 
 from Controls import Controls
 
-from Car import Car     # Use for Controls only
+from Car import Car
 
 from CarManual import CarManual
 from CarAI import CarAI
+from Neuron import NeuralNetwork as NN
+from Evolution import Evolution
 
 from Map import Map
+from Population import Population
+from Termination import Termination
+from Timings import Timings
+from Sensors import Sensors
 
 class Game(Controls):
 
     LAPS_COUNT_MAX = 3
 
+    BRAINS_DIR = 'brains'
+    BRAIN_FORMATS = ['npz', 'json']
+    BRAIN_FORMAT = BRAIN_FORMATS[0]
+    SAVE_POPULATION = False     # Also archive the genomes of the whole generation when the game ends
+
+    CHECKPOINT_FILE = f'{BRAINS_DIR}/checkpoint.npz'
+    CHECKPOINT_EVERY = 10       # in generations, 0 to disable the checkpoints
+    CHECKPOINT_VERSION = 2
+
     __CONTROLS__ = {
         config.KEYS.GAME.NEXT.RESET: 'Reset game',
         config.KEYS.GAME.NEXT.GEN: 'Next generation',
@@ -24,18 +45,29 @@ class Game(Controls):
     }
     __CONTROLS_SUBCLASSES__ = [ Car, Map ]
 
-    def __init__(self, map_files, screen, pop_count=10, brain_file=None):
+    def __init__(self, map_files, screen, pop_count=10, brain_file=None, seed=None, checkpoint_file=None):
+        """checkpoint_file: resume the training saved in this checkpoint (map_files, pop_count and seed are ignored)"""
         self._pop_count = int(pop_count)
         self._cars = []
+        self._population = None
+        self._termination = None
 
         self._border_color = (255, 255, 255)
 
-        w, h = screen.get_size()
-        self._view_map = screen.subsurface((0, 0), (w, h))  #//TEMP revoir plus tard le decoupage des subscreens
-        self._view_brain = screen.subsurface((0, 0), (w, h))  #//TEMP revoir plus tard le decoupage des subscreens
+        # No screen means headless mode: nothing is drawn
+        self._screen = screen
+        self._view_map = None
+        self._view_brain = None
+        if screen is not None:
+            w, h = screen.get_size()
+            self._view_map = screen.subsurface((0, 0), (w, h))  #//TEMP revoir plus tard le decoupage des subscreens
+            self._view_brain = screen.subsurface((0, 0), (w, h))  #//TEMP revoir plus tard le decoupage des subscreens
 
         self._map = None
+        # Visible part of the map, drawn then blitted on the view at once
         self._map_screen = None
+        if screen is not None:
+            self._map_screen = pygame.Surface(self._view_map.get_size()).convert_alpha()
         self._map_files = map_files
         self._cur_map_index = -1
         self._map_gen = 0
@@ -47,30 +79,56 @@ class Game(Controls):
         self._is_drawing_best_only = False
 
         self._gen = 0
+        self._gen_count = 0
         self._best = None
         self._old_best = None
 
-        self.load_next_map()
-        self._populate(brain_file=brain_file)
+        # Time step of the simulation, known from the first update (saved in the checkpoints)
+        self._delta_time = None
+
+        self._evolution = Evolution(seed)
+        if seed is not None:
+            # Global generators too, for any draw outside of the Evolution
+            random.seed(seed)
+            np.random.seed(seed)
+
+        if checkpoint_file is not None:
+            self._load_checkpoint(checkpoint_file)
+        else:
+            self.load_next_map()
+            self._populate(brain_file=brain_file)
+
+    def warmup(self, evaluator=None):
+        """
+        Loads the numba kernels of the simulation before its first step (see Population.warmup):
+        in the worker processes of `evaluator` if it has some, else in this process
+        """
+        if evaluator is not None and evaluator.workers > 1:
+            evaluator.start(self._map)
+        else:
+            Population.warmup(self._map)
+
+    @property
+    def delta_time(self):
+        """Time step of the simulation so far (the one of the resumed training), None before the first update"""
+        return self._delta_time
 
     @property
     def is_manual_mode(self):
         return self._pop_count == 0
 
-    def _get_start_pos(self):
-        pt = self._map.path[0].start
-        x, y = (pt.real, pt.imag)
-        return (int(x), int(y))
-
-    def _get_start_heading(self):
-        pt_start = self._map.path[0].start
-        pt_end = self._map.path[0].end
+    @property
+    def is_headless(self):
+        return self._screen is None
 
-        vec_start = Vec(pt_start.real, pt_start.imag)
-        vec_end = Vec(pt_end.real, pt_end.imag)
-        angle = Vec().angle_to(vec_end - vec_start)
+    @property
+    def cars_count(self):
+        return len(self._cars)
 
-        return int(angle)
+    @property
+    def generations_count(self):
+        """Count of populations evaluated so far (next generation and next map both start a new one)"""
+        return self._gen_count
 
     def load_next_map(self):
         assert len(self._map_files) > 0, "Not any map file given"
@@ -83,15 +141,15 @@ class Game(Controls):
         map_name = self._map_files[self._cur_map_index]
 
         self._map = Map(map_name)
-        self._map_screen = pygame.Surface(self._map.size).convert_alpha()
 
-        self._start_pos = Vec(self._get_start_pos())
-        self._start_heading = self._get_start_heading()
+        self._start_pos = Vec(self._map.start_pos)
+        self._start_heading = self._map.start_heading
 
         print(f'{self._map.stonemiles_count} stonemiles')
 
     def _populate(self, mutate=False, brain_file=None):
         self._cars = []
+        genomes = None
 
         if self.is_manual_mode:
             c = CarManual(self._start_pos, self._start_heading, self._map_gen, self._map.stonemiles_count)
@@ -99,29 +157,55 @@ class Game(Controls):
             self._best = c
             c.is_best = True
             self._cars.append(c)
-            return
-
-        # Populate from a pre-trained neuron network (aka brain)
+        else:
+            genomes = self._create_genomes(mutate, brain_file)
+            self._cars = self._create_cars(genomes)
+
+            if brain_file is not None:
+                loaded_car = self._cars[0]
+                self._old_best = loaded_car
+                self._best = loaded_car
+                loaded_car.is_best = True
+
+        self._population = Population(self._cars, genomes)
+        self._termination = None
+
+        Timings.start_generation(f'{self._map_gen}-{self._gen}')
+
+    def _create_cars(self, genomes):
+        return [CarAI.from_genome(self._start_pos, self._start_heading, self._map_gen, self._map.stonemiles_count, genome)
+                for genome in genomes]
+
+    def _parents(self):
+        """Genomes and fitness of the cars of the ended generation, and of the best car of the previous ones"""
+        cars = list(self._population.cars)
+        genomes = [self._population.genomes]
+        if self._best is not None and self._best not in cars:
+            cars.append(self._best)
+            genomes.append(self._best.brain.to_genome()[np.newaxis])
+        return np.concatenate(genomes), np.array([car.fitness for car in cars])
+
+    def _create_genomes(self, mutate=False, brain_file=None):
+        """Genome matrix [cars, params_count] of the brains of the new population"""
+        genomes = []
+
+        # Populate from a pre-trained neuron network (aka brain), or from all the brains of a population archive
         if brain_file is not None:
-            loaded_car = CarAI.load(self._start_pos, self._start_heading, self._map_gen, self._map.stonemiles_count, brain_file)
-            self._old_best = loaded_car
-            self._best = loaded_car
-            loaded_car.is_best = True
-            self._cars.append(loaded_car)
+            brains, shape = NN.load_genomes(brain_file)
+            if shape != CarAI.brain_shape():
+                raise ValueError(f'{brain_file}: brain shape {shape} does not match the cars one {CarAI.brain_shape()}')
+            genomes.append(brains)
 
         if mutate:
-            # Populate with clones of the best car
-            for _ in range(self._pop_count):
-                c = self._best.clone(self._map_gen, self._map.stonemiles_count)
-                if self._pop_count > 0:
-                    c.mutate()
-                self._cars.append(c)
+            # Populate with the children of the cars of the ended generation (see Evolution.SELECTION)
+            parents, fitness = self._parents()
+            genomes.append(self._evolution.next_generation(parents, fitness, self._pop_count))
         else:
             # Populate with full random new cars
-            for _ in range(max(self._pop_count, 1)):
-                c = CarAI(self._start_pos, self._start_heading, self._map_gen, self._map.stonemiles_count)
-                self._cars.append(c)
+            params_count = NN.params_count(*CarAI.brain_shape())
+            genomes.append(self._evolution.random_genomes(max(self._pop_count, 1), params_count))
 
+        return np.concatenate(genomes)
 
     def reset_game(self):
         self._gen = 0
@@ -167,28 +251,50 @@ class Game(Controls):
         print(f'#{self._map_gen}-{self._gen}: {self._best}')
 
         self._gen += 1
+        self._gen_count += 1
         self._old_best = self._best
 
         self._populate(mutate=True)
+        self._auto_checkpoint()
 
     def next_map(self):
         self.load_next_map()
 
         if not self.is_manual_mode:
             self._select_best()
-            self._best.reset()
             self._old_best = self._best
 
+        self._gen_count += 1
         self._populate(mutate=True)
 
+        # The best car starts again on the new map (after breeding, its fitness on the ended map was needed)
+        if not self.is_manual_mode:
+            self._best.reset()
+        self._auto_checkpoint()
+
+    def _best_fitness(self):
+        """Fitness of the best car of the previous generations (if not part of the current one)"""
+        if self._old_best is None or self._old_best in self._cars:
+            return 0.
+        return self._old_best.fitness
+
     def update(self, delta_time):
-        alive_counter = 0
-        for car in self._cars:
-            if not car.is_dead:
-                alive_counter += 1
-                car.update(self._map, delta_time)
+        self._delta_time = delta_time
+        alive_counter = self._population.update(self._map, delta_time)
 
+        if not self.is_manual_mode:
+            start = Timings.start()
+            # Created at the first update, once the best car of the previous generations is reset on a new map
+            if self._termination is None:
+                self._termination = Termination(self._cars, self._map, delta_time, self.LAPS_COUNT_MAX,
+                                                self._best_fitness())
+            if self._termination.update():
+                print(f'  {Termination.describe(self._termination.result)}')
+            Timings.stop('termination', start)
+
+        start = Timings.start()
         self._select_best()
+        Timings.stop('select_best', start)
 
         if self._best.laps_count > self.LAPS_COUNT_MAX:
             self.next_map()
@@ -196,34 +302,227 @@ class Game(Controls):
         if alive_counter == 0:
             self.next_gen()
 
+    def evaluate_generation(self, evaluator, delta_time):
+        """
+        Same as updating the game until the end of the generation, but the whole generation
+        is evaluated at once by `evaluator` (see Evaluator). Returns the count of steps.
+        """
+        assert not self.is_manual_mode
+        self._delta_time = delta_time
+
+        stats, steps, termination = evaluator.evaluate(self._map, self._population.genomes, self._map_gen, delta_time,
+                                                       self.LAPS_COUNT_MAX, self._best_fitness())
+        if termination[0] is not None:
+            print(f'  {Termination.describe(termination)}')
+        for car, car_stats in zip(self._cars, stats):
+            car.set_stats(car_stats)
+            car.dead()
+
+        self._select_best()
+
+        if self._best.laps_count > self.LAPS_COUNT_MAX:
+            self.next_map()
+        else:
+            self.next_gen()
+
+        return steps
+
     def _save_brain(self):
         if not self._old_best or \
             self.is_manual_mode:
             return
 
-        fname = f'brains/car_MG{self._map_gen:03d}_G{self._gen:03d}_F{int(self._old_best.fitness):05d}.json'
+        fname = f'{self.BRAINS_DIR}/car_MG{self._map_gen:03d}_G{self._gen:03d}_F{int(self._old_best.fitness):05d}.{self.BRAIN_FORMAT}'
         self._old_best.dump(fname)
         print(f' - Saved brain to: {fname}')
 
+    def _save_population(self):
+        if self._population is None or \
+            self._population.genomes is None:
+            return
+
+        fname = f'{self.BRAINS_DIR}/population_MG{self._map_gen:03d}_G{self._gen:03d}.npz'
+        NN.dump_genomes(fname, self._population.genomes, CarAI.brain_shape())
+        print(f' - Saved population ({len(self._population)} brains) to: {fname}')
+
+    def _auto_checkpoint(self):
+        if self.CHECKPOINT_EVERY > 0 and \
+            self._gen_count % self.CHECKPOINT_EVERY == 0:
+            self.save_checkpoint(self.CHECKPOINT_FILE)
+
+    @staticmethod
+    def _training_settings():
+        """Settings shaping a training besides its state (the command line ones), saved in its checkpoints"""
+        return {
+            'selection': Evolution.SELECTION,
+            'tournament_size': Evolution.TOURNAMENT_SIZE,
+            'crossover': Evolution.CROSSOVER,
+            'elitism': Evolution.ELITISM,
+            'mutation_rate': Evolution.MUTATION_RATE,
+            'mutation_scale': Evolution.MUTATION_SCALE,
+            'termination': list(Termination.settings()),
+            'fitness_progress': CarAI.FITNESS_PROGRESS,
+            'raycasting': Sensors.raycasting_mode(),
+            'sense_cars': Sensors.sensing_cars(),
+        }
+
+    @staticmethod
+    def _set_training_settings(settings):
+        Evolution.SELECTION = settings['selection']
+        Evolution.TOURNAMENT_SIZE = settings['tournament_size']
+        Evolution.CROSSOVER = settings['crossover']
+        Evolution.ELITISM = settings['elitism']
+        Evolution.MUTATION_RATE = settings['mutation_rate']
+        Evolution.MUTATION_SCALE = settings['mutation_scale']
+        Termination.set_settings(*settings['termination'])
+        CarAI.FITNESS_PROGRESS = settings['fitness_progress']
+        Sensors.set_raycasting_mode(settings['raycasting'])
+        Sensors.set_sensing_cars(settings['sense_cars'])
+
+    def save_checkpoint(self, file_name):
+        """
+        Saves the training state at the start of the current generation (its genomes are not evaluated yet,
+        the progress of a generation being evaluated is lost), so that a resumed run continues exactly
+        like the saved one. The file is replaced atomically: a crash while saving keeps the previous one.
+        """
+        if self.is_manual_mode:
+            return
+
+        best_row = -1
+        best_genome = np.zeros(0)
+        best_stats = None
+        if self._old_best is not None:
+            if self._old_best in self._cars:
+                best_row = self._cars.index(self._old_best)
+            else:
+                best_genome = self._old_best.brain.to_genome()
+                best_stats = self._old_best.stats
+
+        np_random_state = np.random.get_state()
+        state = {
+            'version': self.CHECKPOINT_VERSION,
+            'map_files': list(self._map_files),
+            'map_index': self._cur_map_index,
+            'map_gen': self._map_gen,
+            'pop_count': self._pop_count,
+            'gen': self._gen,
+            'gen_count': self._gen_count,
+            'sensors_angles': Sensors.sensors_angles().tolist(),
+            'settings': self._training_settings(),
+            'delta_time': self._delta_time,
+            'best_row': best_row,
+            'best_stats': best_stats,
+            'evolution_rng': self._evolution.rng.bit_generator.state,
+            'np_random': [np_random_state[0], *np_random_state[2:]],
+            'random': random.getstate(),
+        }
+
+        tmp_file_name = f'{file_name}.tmp'
+        with open(tmp_file_name, 'wb') as f:
+            np.savez(f, state=np.array(json.dumps(state)),
+                     genomes=self._population.genomes,
+                     best_genome=best_genome,
+                     np_random_keys=np_random_state[1])
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file_name, file_name)
+
+        print(f' - Saved checkpoint to: {file_name}')
+
+    def _load_checkpoint(self, file_name):
+        with np.load(file_name) as data:
+            state = json.loads(str(data['state']))
+            genomes = data['genomes'].copy()
+            best_genome = data['best_genome'].copy()
+            np_random_keys = data['np_random_keys']
+
+        if state['version'] > self.CHECKPOINT_VERSION:
+            raise ValueError(f'{file_name}: unsupported checkpoint version {state["version"]}')
+
+        # The brains inputs depend on the sensors
+        Sensors.set_sensors_angles(state['sensors_angles'])
+
+        # The saved training continues with its own settings, whatever the command line ones (version 2)
+        if 'settings' in state:
+            settings = state['settings']
+            current = self._training_settings()
+            changed = ', '.join(f'{name}={value}' for name, value in settings.items() if current.get(name) != value)
+            if changed:
+                print(f'Resuming with the settings of the checkpoint: {changed}')
+            self._set_training_settings(settings)
+            self._delta_time = state['delta_time']
+
+        self._map_files = state['map_files']
+        self._pop_count = state['pop_count']
+        self._map_gen = state['map_gen']
+        self._cur_map_index = state['map_index'] - 1
+        self.load_next_map()
+
+        self._gen = state['gen']
+        self._gen_count = state['gen_count']
+
+        self._evolution.rng.bit_generator.state = state['evolution_rng']
+        name, *np_random_state = state['np_random']
+        np.random.set_state((name, np_random_keys, *np_random_state))
+        version, internal_state, gauss_next = state['random']
+        random.setstate((version, tuple(internal_state), gauss_next))
+
+        self._cars = self._create_cars(genomes)
+        self._population = Population(self._cars, genomes)
+
+        Timings.start_generation(f'{self._map_gen}-{self._gen}')
+
+        if state['best_row'] >= 0:
+            self._old_best = self._cars[state['best_row']]
+        elif state['best_stats'] is not None:
+            self._old_best = CarAI.from_genome(self._start_pos, self._start_heading, self._map_gen,
+                                               self._map.stonemiles_count, best_genome)
+            self._old_best.set_stats(state['best_stats'])
+        self._best = self._old_best
+        if self._best is not None:
+            self._best.is_best = True
+
+        print(f'Resumed from checkpoint: {file_name} (#{self._map_gen}-{self._gen}, {len(self._cars)} cars)')
+
     def end_game(self):
         self._save_brain()
+        if self.SAVE_POPULATION:
+            self._save_population()
+        if self.CHECKPOINT_EVERY > 0:
+            self.save_checkpoint(self.CHECKPOINT_FILE)
+
+    def _draw_map(self, screen, debug=False, alpha=1.):
+        """Only the view around the best car is drawn: the cost depends on the window size, not on the map size"""
+        if self._best is None:
+            # Not any step simulated yet in this generation
+            self._select_best()
+
+        w, h = self._map_screen.get_size()
+        best_pos, _ = self._best.body.interpolated_pose(alpha)
+        view = pygame.Rect(best_pos - Vec(w // 2, h // 2), (w, h))     # in map coordinates
+        offset = view.topleft
 
-    def _draw_map(self, screen, debug=False):
-        self._map_screen.fill((0, 0, 0, 0))      #//TEMP ici ou a la creation uniquement ?
+        self._map_screen.fill((0, 0, 0, 0))
 
-        self._map.draw(self._map_screen)
+        self._map.draw(self._map_screen, view=view)
 
         if not self._is_drawing_best_only:
+            # Cars (and their sensors) reaching into the view only
+            margin = Car.CAR_W + (Sensors.SENSOR_SIZE_MAX if Sensors.is_drawing() else 0)
+            visible = view.inflate(2 * margin, 2 * margin)
             for car in self._cars:
-                if not car.is_best:
-                    car.draw(self._map_screen, debug)
+                if not car.is_best and \
+                   not car.is_dead and \
+                   visible.collidepoint(car.pos):
+                    car.draw(self._map_screen, debug, alpha, offset)
 
-        self._best.draw(self._map_screen, debug)
+        self._best.draw(self._map_screen, debug, alpha, offset)
 
-        w, h = self._view_map.get_size()
-        centered_pos = self._best.pos - Vec(w // 2, h // 2)
+        screen.blit(self._map_screen, (0, 0))
 
-        screen.blit(self._map_screen, (0, 0), (*centered_pos, *self._map_screen.get_size()))
+    def draw(self, debug=False, alpha=1.):
+        """alpha: how far (0 to 1) in the last simulation step the cars are drawn"""
+        if self.is_headless:
+            return
 
-    def draw(self, debug=False):
-        self._draw_map(self._view_map, debug)
+        self._draw_map(self._view_map, debug, alpha)
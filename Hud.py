@@ -0,0 +1,31 @@
+import pygame
+
+
+class Hud(object):
+    """
+    Fonts and rendered texts of the overlays, cached: a font is created once,
+    and a text is rendered once per font and color (the values drawn are rounded, so they repeat).
+    """
+
+    TEXTS_CACHE_MAX = 4096      # Rendered texts kept, the cache is emptied when full
+
+    _fonts = {}
+    _texts = {}
+
+    @classmethod
+    def font(cls, name, size):
+        key = (name, size)
+        font = cls._fonts.get(key)
+        if font is None:
+            font = cls._fonts[key] = pygame.font.SysFont(name, size)
+        return font
+
+    @classmethod
+    def text(cls, text, font_name, size, color=(0, 0, 0), antialias=True):
+        key = (text, font_name, size, color, antialias)
+        surface = cls._texts.get(key)
+        if surface is None:
+            if len(cls._texts) >= cls.TEXTS_CACHE_MAX:
+                cls._texts.clear()
+            surface = cls._texts[key] = cls.font(font_name, size).render(text, antialias, color)
+        return surface
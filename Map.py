@@ -1,16 +1,249 @@
 #!/usr/bin/env python3
 
+import os
+import math
+import shutil
+import hashlib
+
 import pygame
 from pygame.math import Vector2 as Vec
 
-from svgpathtools import svg2paths, Line, Path
+import numpy as np
+from numba import jit
+
 
 import config
 
 from Controls import Controls
+from CarPhysics import CarPhysics
 
 from QuadTree import QuadTree
 
+@jit(nopython=True, cache=True)
+def mask_is_on_road(mask_array, bitpacked, x, y):
+    """Lookup of the pixel (x, y) of a Map mask_array (x and y are in bounds)"""
+    if bitpacked:
+        return (mask_array[x, y >> 3] >> (7 - (y & 7))) & 1 == 1
+    return mask_array[x, y]
+
+
+@jit(nopython=True, cache=True)
+def _centerline_projection(centerline, arcs, segment, x, y):
+    """(squared distance, arc length) of the projection of (x, y) on a segment of the closed centerline"""
+    count = len(centerline)
+    ax, ay = centerline[segment, 0], centerline[segment, 1]
+    dx = centerline[(segment + 1) % count, 0] - ax
+    dy = centerline[(segment + 1) % count, 1] - ay
+
+    length_2 = dx * dx + dy * dy
+    t = 0.
+    if length_2 > 0.:
+        t = min(max(((x - ax) * dx + (y - ay) * dy) / length_2, 0.), 1.)
+
+    px = x - (ax + t * dx)
+    py = y - (ay + t * dy)
+    return px * px + py * py, arcs[segment] + t * (arcs[segment + 1] - arcs[segment])
+
+
+@jit(nopython=True, cache=True)
+def _centerline_nearest(centerline, arcs, first, end, x, y):
+    """(k, segment, arc length) of the nearest projection of (x, y) on the segments k % count of range(first, end)"""
+    count = len(centerline)
+    best_distance = np.inf
+    best_k, best_segment, best_arc = first, 0, 0.
+    for k in range(first, end):
+        segment = k % count
+        distance, arc = _centerline_projection(centerline, arcs, segment, x, y)
+        if distance < best_distance:
+            best_distance = distance
+            best_k, best_segment, best_arc = k, segment, arc
+    return best_k, best_segment, best_arc
+
+
+@jit(nopython=True, cache=True)
+def track_update(centerline, arcs, positions, track, window):
+    """
+    Progress along the closed centerline (see Map.centerline) of the points positions [n, 2],
+    from their rows of track [n, 4] updated in place: (segment, lap fraction, progress, best progress),
+    the progresses in laps since the first update (segment -1). Each point is projected on the `window` segments
+    around its last one only, as it moves a few pixels per step, and on all of them at the first update
+    or when the nearest one is at an edge of the window (it may be further).
+    """
+    count = len(centerline)
+    length = arcs[count]
+
+    for i in range(len(positions)):
+        x, y = positions[i, 0], positions[i, 1]
+        last = int(track[i, 0])
+
+        if last >= 0 and 2 * window + 1 < count:
+            first, end = last - window, last + window + 1
+            k, best_segment, best_arc = _centerline_nearest(centerline, arcs, first, end, x, y)
+            if k == first or k == end - 1:
+                k, best_segment, best_arc = _centerline_nearest(centerline, arcs, 0, count, x, y)
+        else:
+            k, best_segment, best_arc = _centerline_nearest(centerline, arcs, 0, count, x, y)
+
+        lap_fraction = best_arc / length
+        if lap_fraction >= 1.:
+            lap_fraction -= 1.
+
+        if last < 0:
+            track[i, 2] = 0.
+            track[i, 3] = 0.
+        else:
+            # Shortest way around the lap from the last position
+            delta = lap_fraction - track[i, 1]
+            if delta > .5:
+                delta -= 1.
+            elif delta < -.5:
+                delta += 1.
+            track[i, 2] += delta
+            track[i, 3] = max(track[i, 3], track[i, 2])
+
+        track[i, 0] = best_segment
+        track[i, 1] = lap_fraction
+
+
+@jit(nopython=True, cache=True)
+def _turn_extent(ux, uy, vx, vy, radius):
+    """
+    Length past a vertex of the road around a polyline, where the road of a segment (direction (ux, uy))
+    still has to be rasterized to cover the outer side of the turn to the next segment (direction (vx, vy))
+    """
+    if ux * vx + uy * vy <= 0.:
+        return radius
+    # radius * sin(turn angle)
+    return radius * abs(ux * vy - uy * vx)
+
+
+@jit(nopython=True, cache=True)
+def road_raster(polyline, radius, w, h):
+    """
+    Road of the pixels [w, h] whose centers are within `radius` of the closed polyline [n, 2], and its distance field:
+    a lower bound of the distance from each road pixel to the nearest one out of the road (0 out of the road),
+    floored like a distance transform. It is radius minus the distance to the polyline, exact except where
+    parts of the road overlap, which is enough for the sphere tracing (see Sensors._sphere_tracing).
+    Each segment only rasterizes the band of the pixels it can be the nearest segment of, not its whole bounding box.
+    radius is at most 254 (the distances are in bytes).
+    """
+    # Rasterized as floor(radius - distance to the polyline) + 1 for the road, 0 elsewhere
+    distance = np.zeros((w, h), dtype=np.uint8)
+    radius_2 = radius * radius
+
+    count = len(polyline)
+    directions = np.zeros((count, 2))
+    lengths = np.zeros(count)
+    for k in range(count):
+        dx = polyline[(k + 1) % count, 0] - polyline[k, 0]
+        dy = polyline[(k + 1) % count, 1] - polyline[k, 1]
+        lengths[k] = math.sqrt(dx * dx + dy * dy)
+        if lengths[k] > 0.:
+            directions[k, 0], directions[k, 1] = dx / lengths[k], dy / lengths[k]
+
+    for k in range(count):
+        length = lengths[k]
+        if length == 0.:
+            continue
+        ax, ay = polyline[k, 0], polyline[k, 1]
+        ux, uy = directions[k, 0], directions[k, 1]
+
+        # Band of the segment: along it from s_min to s_max (past its ends for the turns), across it within radius
+        s_min, s_max = -radius, length + radius
+        if lengths[k - 1] > 0.:
+            s_min = -_turn_extent(directions[k - 1, 0], directions[k - 1, 1], ux, uy, radius) - 1.
+        if lengths[(k + 1) % count] > 0.:
+            s_max = length + _turn_extent(ux, uy, directions[(k + 1) % count, 0], directions[(k + 1) % count, 1], radius) + 1.
+
+        x_min = min(s_min * ux, s_max * ux) - radius * abs(uy)
+        x_max = max(s_min * ux, s_max * ux) + radius * abs(uy)
+        for x in range(max(int(math.floor(ax + x_min)), 0), min(int(math.ceil(ax + x_max)) + 1, w)):
+            px = x + .5 - ax
+
+            # Column of the band: s = px * ux + py * uy in [s_min, s_max], n = py * ux - px * uy in [-radius, radius]
+            py_min, py_max = -np.inf, np.inf
+            if uy != 0.:
+                py_min = max(py_min, min((s_min - px * ux) / uy, (s_max - px * ux) / uy))
+                py_max = min(py_max, max((s_min - px * ux) / uy, (s_max - px * ux) / uy))
+            elif not s_min <= px * ux <= s_max:
+                continue
+            if ux != 0.:
+                py_min = max(py_min, min((px * uy - radius) / ux, (px * uy + radius) / ux))
+                py_max = min(py_max, max((px * uy - radius) / ux, (px * uy + radius) / ux))
+            elif not -radius <= -px * uy <= radius:
+                continue
+
+            for y in range(max(int(math.floor(ay + py_min)) - 1, 0), min(int(math.ceil(ay + py_max)) + 1, h)):
+                py = y + .5 - ay
+                t = min(max(px * ux + py * uy, 0.), length)
+                ex = px - t * ux
+                ey = py - t * uy
+                d_2 = ex * ex + ey * ey
+                if d_2 < radius_2:
+                    distance[x, y] = max(distance[x, y], int(radius - math.sqrt(d_2)) + 1)
+
+    road = np.zeros((w, h), dtype=np.bool_)
+    for x in range(w):
+        for y in range(h):
+            if distance[x, y] > 0:
+                road[x, y] = True
+                # Outside of the image is out of the road too
+                distance[x, y] = max(min(distance[x, y] - 1, x + 1, y + 1, w - x, h - y), 1)
+
+    return road, distance
+
+
+@jit(nopython=True, cache=True)
+def stonemiles_raster(stonemiles, radius, road):
+    """Index of the nearest stonemile [n, 2] within `radius` of each pixel (center) of the road [w, h], -1 elsewhere"""
+    w, h = road.shape
+    stonemiles_array = np.full((w, h), -1, dtype=np.int16)
+
+    r = int(radius)
+    for stonemile_i in range(len(stonemiles)):
+        pt_x, pt_y = stonemiles[stonemile_i, 0], stonemiles[stonemile_i, 1]
+        x0, x1 = max(int(pt_x) - r, 0), min(int(pt_x) + r + 1, w)
+        y0, y1 = max(int(pt_y) - r, 0), min(int(pt_y) + r + 1, h)
+        for x in range(x0, x1):
+            for y in range(y0, y1):
+                if not road[x, y]:
+                    continue
+                dist = math.sqrt((x + .5 - pt_x) ** 2 + (y + .5 - pt_y) ** 2)
+                if dist >= radius:
+                    continue
+
+                # Nearest one so far (the first one wins the ties), its distance is compared in simple precision
+                nearest_i = stonemiles_array[x, y]
+                if nearest_i >= 0:
+                    nearest_dist = np.float32(math.sqrt((x + .5 - stonemiles[nearest_i, 0]) ** 2 +
+                                                        (y + .5 - stonemiles[nearest_i, 1]) ** 2))
+                    if not dist < nearest_dist:
+                        continue
+                stonemiles_array[x, y] = stonemile_i
+
+    return stonemiles_array
+
+
+def segment_points(segment, ts, derivative=False):
+    """
+    Points (or first derivatives) of a svgpathtools segment at the parameters ts [n], as complex [n]:
+    Béziers (lines included) are evaluated in bulk from their Bernstein form, arcs point by point
+    """
+    if not hasattr(segment, 'bpoints'):
+        func = segment.derivative if derivative else segment.point
+        return np.array([func(t) for t in ts], dtype=np.complex128)
+
+    bpoints = np.array(segment.bpoints(), dtype=np.complex128)
+    if derivative:
+        bpoints = np.diff(bpoints) * (len(bpoints) - 1)
+
+    degree = len(bpoints) - 1
+    ts = np.asarray(ts, dtype=np.float64)[:, np.newaxis]
+    k = np.arange(degree + 1)
+    binomials = np.array([math.comb(degree, i) for i in k])
+    return (binomials * ts ** k * (1. - ts) ** (degree - k)) @ bpoints
+
+
 class Map(Controls):
 
     __CONTROLS__ = {
@@ -37,17 +270,52 @@ class Map(Controls):
 
     QUADTREE_BUCKET_SIZE = 5
 
-    def __init__(self, filename):
+    SCALE = 13.75
+
+    # Compiled maps cache (None to disable it), invalidated by any change of the SVG file or of the
+    # build parameters (_CACHE_PARAMS). CACHE_VERSION is to be increased when the way a map is built changes.
+    CACHE_DIR = 'maps/.cache'
+    CACHE_VERSION = 4
+
+    # Track centerline resampled every CENTERLINE_STEP pixels, a car progress is projected on the
+    # CENTERLINE_WINDOW segments around its last one (see track_update): wider than a step at full speed
+    CENTERLINE_STEP = 4.
+    CENTERLINE_WINDOW = math.ceil(CarPhysics.MAX_VELOCITY / CENTERLINE_STEP) + 8
+
+    # The road is rasterized around the centerline resampled every ROAD_STEP pixels (see road_raster)
+    ROAD_STEP = 16.
+
+    # Collision mask stored with 8 pixels per byte (see mask_array)
+    MASK_BITPACKED = False
+    _CACHE_ARRAYS = ('distance_array', 'stonemiles_array')
+
+    # Build parameters of everything cached (arrays, centerline and images), hashed in the cache key
+    _CACHE_PARAMS = ('CACHE_VERSION', 'SCALE', 'PATH_RADIUS', 'POINTS_PER_SEGMENT', 'CENTERLINE_STEP', 'ROAD_STEP',
+                     'SEGMENTS_DRAW_LINE_COUNT', 'COLOR_BG', 'COLOR_PATH', 'COLOR_PATH_BORDER_1', 'COLOR_PATH_BORDER_2',
+                     'COLOR_STONEMILE')
+    _CACHE_IMAGES = ('image', 'image_debug')
+
+    def __init__(self, filename=None):
+        """Without filename, the map is empty (see from_arrays)"""
         self._path = None
 
+        self._start_pos = None
+        self._start_heading = None
+
         self._image = None
         self._image_debug = None
-        self._mask = None
+        self._image_with_debug = None
+        self._images_cache_path = None      # Cache entry the images are loaded from at their first use
         self._mask_array = None
+        self._distance_array = None
+        self._stonemiles_array = None
 
         self._path_tree = None
         self._stonemiles = []
-        self._build_path(filename)
+        self._centerline = None
+        self._centerline_arcs = None
+        if filename is not None:
+            self._load(filename)
 
         self._is_drawing = True
         self._is_drawing_debug = False
@@ -58,17 +326,80 @@ class Map(Controls):
 
     @property
     def size(self):
-        assert self._image is not None
-        return self._image.get_size()
+        assert self._distance_array is not None
+        return self._distance_array.shape
+
+    @property
+    def start_pos(self):
+        return self._start_pos
+
+    @property
+    def start_heading(self):
+        return self._start_heading
+
+    @property
+    def stonemiles(self):
+        return self._stonemiles
 
     @property
     def stonemiles_count(self):
         return len(self._stonemiles)
 
+    @property
+    def centerline(self):
+        """Points [n, 2] of the closed track centerline, from the start position, about CENTERLINE_STEP apart"""
+        return self._centerline
+
+    @property
+    def centerline_arcs(self):
+        """Arc length [n + 1] of each centerline point from the start, the last one is the track length"""
+        return self._centerline_arcs
+
+    @property
+    def track_length(self):
+        return float(self._centerline_arcs[-1])
+
+    @classmethod
+    def from_arrays(cls, mask_array, distance_array, stonemiles_array, stonemiles, start_pos, start_heading, centerline):
+        """Map with only what the simulation needs (no path, no images), from already built arrays"""
+        game_map = cls()
+        game_map._mask_array = mask_array
+        game_map._distance_array = distance_array
+        game_map._stonemiles_array = stonemiles_array
+        game_map._stonemiles = [Vec(float(x), float(y)) for x, y in stonemiles]
+        game_map._start_pos = tuple(start_pos)
+        game_map._start_heading = start_heading
+        game_map._set_centerline(centerline)
+        return game_map
+
     @property
     def mask_array(self):
+        """
+        Collision mask, True on the road: contiguous boolean array [w, h],
+        or bit-packed along y as uint8 [w, ceil(h / 8)] (see mask_bitpacked and mask_is_on_road)
+        """
         return self._mask_array
 
+    @property
+    def mask_bitpacked(self):
+        return self._mask_array.dtype == np.uint8
+
+    def _set_mask(self, road):
+        if self.MASK_BITPACKED:
+            self._mask_array = np.packbits(road, axis=1)
+        else:
+            self._mask_array = np.ascontiguousarray(road, dtype=np.bool_)
+
+    @property
+    def stonemiles_array(self):
+        """Nearest stonemile index of each pixel on the road, -1 elsewhere (see get_stonemile)"""
+        return self._stonemiles_array
+
+    @property
+    def distance_array(self):
+        """Floored distance (in pixels, up to 255) from each pixel to the nearest pixel out of the road (0 out of the road)"""
+        return self._distance_array
+
     def event(self, event):
         if event.type == pygame.KEYDOWN:
             # Map controls
@@ -80,12 +411,37 @@ class Map(Controls):
                 self._is_drawing_debug = not self._is_drawing_debug
 
     def point_is_on_path(self, requested_point):
-        w, h, _ = self._mask_array.shape
-        if 0 <= requested_point.x <= w and \
-            0 <= requested_point.y <= h:
-            return self._mask_array[int(requested_point.x), int(requested_point.y), 0] == 255
+        w, h = self.size
+        if 0 <= requested_point[0] < w and \
+            0 <= requested_point[1] < h:
+            x, y = int(requested_point[0]), int(requested_point[1])
+            if self.mask_bitpacked:
+                return (self._mask_array[x, y >> 3] >> (7 - (y & 7))) & 1 == 1
+            return bool(self._mask_array[x, y])
         return False
 
+    def get_stonemile(self, requested_point):
+        """Index of the nearest stonemile (within PATH_RADIUS) of a point on the road, else -1"""
+        w, h = self._stonemiles_array.shape
+        if 0 <= requested_point[0] < w and \
+            0 <= requested_point[1] < h:
+            return int(self._stonemiles_array[int(requested_point[0]), int(requested_point[1])])
+        return -1
+
+    def update_track(self, positions, track):
+        """Updates in place the track rows [n, 4] of the cars at positions [n, 2] (see track_update)"""
+        track_update(self._centerline, self._centerline_arcs, positions, track, self.CENTERLINE_WINDOW)
+
+    def get_stonemiles(self, requested_points):
+        """Batched get_stonemile() of points [n, 2]"""
+        w, h = self._stonemiles_array.shape
+        x, y = requested_points[:, 0], requested_points[:, 1]
+        inside = (0 <= x) & (x < w) & (0 <= y) & (y < h)
+
+        stonemiles = np.full(len(requested_points), -1, dtype=np.int64)
+        stonemiles[inside] = self._stonemiles_array[x[inside].astype(np.intp), y[inside].astype(np.intp)]
+        return stonemiles
+
     def get_path_point(self, requested_point):
         requested_point = Vec(requested_point)
         min_dist = self.PATH_RADIUS * 2
@@ -105,91 +461,256 @@ class Map(Controls):
         return ret
 
     def offset_curve(self, path, offset_distance, steps=10):
-        """Takes in a Path object, `path`, and a distance,
-        `offset_distance`, and outputs an piecewise-linear approximation
-        of the 'parallel' offset curve."""
-        nls = []
-        for seg in path:
-            for k in range(steps):
-                t = k / steps
-                if seg.end == seg.start:
-                    continue
-                offset_vector = offset_distance * seg.normal(t)
-                nl = Line(seg.point(t), seg.point(t) + offset_vector)
-                nls.append(nl)
-        connect_the_dots = [Line(nls[k].end, nls[k+1].end) for k in range(len(nls)-1)]
-        offset_path = Path(*connect_the_dots)
-        return offset_path
-
-    def _build_path_tree(self):
-        stonemiles_cur = 0
+        """
+        Piecewise-linear approximation [n, 2] of the 'parallel' offset curve of the Path `path`,
+        at `offset_distance` along the normals of `steps` points per segment
+        """
+        ts = np.arange(steps) / steps
+        points = []
+        for segment in path:
+            if segment.end == segment.start:
+                continue
+            derivatives = segment_points(segment, ts, derivative=True)
+            lengths = np.abs(derivatives)
+            # Right hand rule unit normals, like segment.normal()
+            normals = -1j * derivatives[lengths > 0] / lengths[lengths > 0]
+            points.append(segment_points(segment, ts[lengths > 0]) + offset_distance * normals)
+        points = np.concatenate(points)
+        return np.column_stack((points.real, points.imag))
+
+    def _sample_path(self):
+        """Points [n, 2] of the path at POINTS_PER_SEGMENT evenly spaced parameters of each segment, and its end"""
+        ts = np.arange(self.POINTS_PER_SEGMENT) / self.POINTS_PER_SEGMENT
+        points = np.concatenate([segment_points(segment, ts) for segment in self._path] + [[self._path[-1].end]])
+        return np.column_stack((points.real, points.imag))
+
+    @staticmethod
+    def _resample(points, step=None, count=None):
+        """Closed polyline through points [n, 2] resampled evenly along its arc length, every `step` pixels or in `count` points"""
+        # Closed: back to the start
+        points = np.concatenate((points, points[:1]))
+        arcs = np.concatenate(([0.], np.cumsum(np.hypot(*np.diff(points, axis=0).T))))
+
+        if count is None:
+            count = max(int(arcs[-1] // step), 3)
+        resampled_arcs = np.linspace(0., arcs[-1], count, endpoint=False)
+        return np.column_stack((np.interp(resampled_arcs, arcs, points[:, 0]),
+                                np.interp(resampled_arcs, arcs, points[:, 1])))
+
+    def _build_stonemiles(self, points):
         prev_stonemile_item = None
 
-        for segment in self._path:
-            for k in range(self.POINTS_PER_SEGMENT):
-                t = k / self.POINTS_PER_SEGMENT
-                item = Vec(segment.point(t).real, segment.point(t).imag)
+        for x, y in points[:-1].tolist():
+            item = Vec(x, y)
+
+            if prev_stonemile_item is None or \
+                prev_stonemile_item.distance_to(item) >= 100:
+                prev_stonemile_item = item
+                self._stonemiles.append(item)
+
+    def _build_centerline(self, points):
+        """Centerline of the path sampled like the stonemiles, then resampled every CENTERLINE_STEP pixels"""
+        self._set_centerline(self._resample(points, step=self.CENTERLINE_STEP))
+
+    def _set_centerline(self, centerline):
+        self._centerline = np.ascontiguousarray(centerline, dtype=np.float64)
+        closed = np.concatenate((self._centerline, self._centerline[:1]))
+        self._centerline_arcs = np.concatenate(([0.], np.cumsum(np.hypot(*np.diff(closed, axis=0).T))))
+
+    def _build_path_tree(self, image_size):
+        self._path_tree = QuadTree((0, 0, image_size[0], image_size[1]), self.QUADTREE_BUCKET_SIZE)
+        for stonemile_i, item in enumerate(self._stonemiles):
+            self._path_tree.insert(item, user_data=stonemile_i)
+
+    def _build_start(self):
+        pt_start = self._path[0].start
+        pt_end = self._path[0].end
+
+        self._start_pos = (int(pt_start.real), int(pt_start.imag))
+
+        vec_start = Vec(pt_start.real, pt_start.imag)
+        vec_end = Vec(pt_end.real, pt_end.imag)
+        self._start_heading = int(Vec().angle_to(vec_end - vec_start))
+
+    def _build_stonemiles_array(self, road):
+        """
+        Raster of the nearest stonemile index (within PATH_RADIUS) of each pixel on the road (-1 elsewhere),
+        same lookup as get_path_point() but precomputed
+        """
+        stonemiles = np.array([(pt.x, pt.y) for pt in self._stonemiles], dtype=np.float64).reshape(-1, 2)
+        self._stonemiles_array = stonemiles_raster(stonemiles, float(self.PATH_RADIUS), road)
+
+    def _load(self, filename):
+        cache_path = self._cache_path(filename)
+        if cache_path is not None and self._load_cache(cache_path):
+            return
+
+        self._build_path(filename)
+
+        if cache_path is not None:
+            self._save_cache(cache_path)
+
+    def _cache_path(self, filename):
+        if self.CACHE_DIR is None:
+            return None
+
+        key = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            key.update(f.read())
+        key.update(':'.join(str(getattr(self, name)) for name in self._CACHE_PARAMS).encode())
+
+        name = os.path.splitext(os.path.basename(filename))[0]
+        return os.path.join(self.CACHE_DIR, f'{name}-{key.hexdigest()[:16]}')
+
+    def _load_cache(self, cache_path):
+        if not os.path.isdir(cache_path):
+            return False
+
+        # Simulation arrays are memory-mapped (read only), not loaded
+        for name in self._CACHE_ARRAYS:
+            setattr(self, f'_{name}', np.load(os.path.join(cache_path, f'{name}.npy'), mmap_mode='r'))
 
-                if prev_stonemile_item is None or \
-                    prev_stonemile_item.distance_to(item) >= 100:
-                    prev_stonemile_item = item
-                    self._stonemiles.append(item)
-                    self._path_tree.insert(item, user_data=stonemiles_cur)
-                    stonemiles_cur += 1
+        # The mask is cached unpacked, to be memory-mapped too when not bit-packed
+        road = np.load(os.path.join(cache_path, 'mask_array.npy'), mmap_mode='r')
+        self._mask_array = np.packbits(road, axis=1) if self.MASK_BITPACKED else road
+
+        # Images are only loaded when drawn: headless runs and workers never do
+        self._images_cache_path = cache_path
+
+        with np.load(os.path.join(cache_path, 'meta.npz')) as meta:
+            self._stonemiles = [Vec(float(x), float(y)) for x, y in meta['stonemiles']]
+            self._set_centerline(meta['centerline'])
+            self._start_pos = tuple(int(v) for v in meta['start_pos'])
+            self._start_heading = int(meta['start_heading'])
+
+        self._build_path_tree(self.size)
+
+        return True
+
+    def _save_cache(self, cache_path):
+        # Written in a temporary directory renamed at the end, so a cache entry is always complete
+        tmp_path = f'{cache_path}.tmp{os.getpid()}'
+        os.makedirs(tmp_path, exist_ok=True)
+
+        for name in self._CACHE_ARRAYS:
+            np.save(os.path.join(tmp_path, f'{name}.npy'), getattr(self, f'_{name}'))
+
+        road = self._mask_array
+        if self.mask_bitpacked:
+            road = np.unpackbits(road, axis=1, count=self.size[1]).astype(np.bool_)
+        np.save(os.path.join(tmp_path, 'mask_array.npy'), road)
+
+        for name in self._CACHE_IMAGES:
+            image = getattr(self, name)
+            w, h = image.get_size()
+            pixels = np.frombuffer(pygame.image.tobytes(image, 'RGBA'), dtype=np.uint8).reshape(h, w, 4)
+            np.save(os.path.join(tmp_path, f'{name}.npy'), pixels)
+
+        np.savez(os.path.join(tmp_path, 'meta.npz'),
+                 stonemiles=np.array([(pt.x, pt.y) for pt in self._stonemiles]),
+                 centerline=self._centerline,
+                 start_pos=np.array(self._start_pos),
+                 start_heading=np.array(self._start_heading))
+
+        try:
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # Already cached meanwhile (by another process)
+            shutil.rmtree(tmp_path, ignore_errors=True)
 
     def _build_path(self, filename):
+        # Imported when a map is built only: svgpathtools (and the scipy modules it imports) is slow to import,
+        # and is not needed to load the cached maps nor in the workers (see Startup)
+        from svgpathtools import svg2paths
+
         paths, _ = svg2paths(filename)
         path = paths[0]
         xmin, xmax, ymin, ymax = path.bbox()
 
-        self._path = path.scaled(complex(13.75))
+        self._path = path.scaled(complex(self.SCALE))
         a,b,c,d = self._path.bbox()
         image_size = (b + 50, d + 50)
 
-        self._path_tree = QuadTree((0, 0, image_size[0], image_size[1]), self.QUADTREE_BUCKET_SIZE)
-        self._build_path_tree()
+        self._build_start()
+
+        # The path is sampled once, in bulk
+        points = self._sample_path()
+        self._build_stonemiles(points)
+        self._build_centerline(points)
+        self._build_path_tree(image_size)
 
-        pts = [(p.real,p.imag) for p in (self._path.point(i / self.SEGMENTS_DRAW_LINE_COUNT) for i in range(0, self.SEGMENTS_DRAW_LINE_COUNT))]
+        # SRCALPHA surfaces do not need a display (unlike convert_alpha()), so maps can be built headless,
+        # and are created transparent
+        self._image = pygame.Surface(image_size, pygame.SRCALPHA)
 
-        self._image = pygame.Surface(image_size).convert_alpha()
-        self._image.fill((0, 0, 0, 0))
+        # Road (collision mask) and its distance field (one byte per pixel to keep the lookups cache friendly),
+        # rasterized from the distances to the centerline
+        w, h = self._image.get_size()
+        road, self._distance_array = road_raster(self._resample(self._centerline, step=self.ROAD_STEP),
+                                                 float(self.PATH_RADIUS), w, h)
+        self._set_mask(road)
 
-        # Draw road
-        for pt in pts:
-            pygame.draw.circle(self._image, self.COLOR_BG, pt, self.PATH_RADIUS)
+        # Draw road (map_rgb() returns a signed int)
+        pixels = pygame.surfarray.pixels2d(self._image)
+        pixels[road] = self._image.map_rgb(self.COLOR_BG) & 0xFFFFFFFF
+        del pixels  # Unlocks the surface
 
         # Draw road middle line
+        pts = self._resample(points[:-1], count=self.SEGMENTS_DRAW_LINE_COUNT).tolist()
         for i in range(0, len(pts), 8):
             pygame.draw.line(self._image, self.COLOR_PATH, pts[i], pts[i+1], 1)
 
-        # Create mask (collision)
-        self._mask = pygame.mask.from_surface(self._image)
-        self._mask_array = pygame.surfarray.array3d(self._mask.to_surface())
+        self._build_stonemiles_array(road)
 
         # Create debug image
-        self._image_debug = pygame.Surface(image_size).convert_alpha()
-        self._image_debug.fill((0, 0, 0, 0))
+        self._image_debug = pygame.Surface(image_size, pygame.SRCALPHA)
 
         for radius, color in [(self.PATH_RADIUS, self.COLOR_PATH_BORDER_1),
                                 (-self.PATH_RADIUS, self.COLOR_PATH_BORDER_2)]:
-            border = self.offset_curve(self._path, radius)
-            pts = [(p.real,p.imag) for p in (border.point(i / self.SEGMENTS_DRAW_LINE_COUNT) for i in range(0, self.SEGMENTS_DRAW_LINE_COUNT))]
+            pts = self.offset_curve(self._path, radius).tolist()
             pygame.draw.aalines(self._image_debug, color, True, pts)
 
         for pt in self._stonemiles:
             pygame.draw.circle(self._image_debug, self.COLOR_STONEMILE, (pt.x, pt.y), 3)
 
-    def draw(self, screen, debug=False):
+    def _get_image(self, name):
+        """Image `name` of _CACHE_IMAGES, loaded from the cache at the first use"""
+        image = getattr(self, f'_{name}')
+        if image is None and self._images_cache_path is not None:
+            pixels = np.load(os.path.join(self._images_cache_path, f'{name}.npy'))
+            h, w, _ = pixels.shape
+            image = pygame.image.frombytes(pixels.tobytes(), (w, h), 'RGBA')
+            setattr(self, f'_{name}', image)
+        return image
+
+    @property
+    def image(self):
+        return self._get_image('image')
+
+    @property
+    def image_debug(self):
+        return self._get_image('image_debug')
+
+    @property
+    def image_with_debug(self):
+        """Map image with the debug layer over it, composited once at the first use"""
+        if self._image_with_debug is None:
+            self._image_with_debug = self.image.copy()
+            self._image_with_debug.blit(self.image_debug, (0, 0))
+        return self._image_with_debug
+
+    def draw(self, screen, debug=False, view=None):
+        """view: area of the map (Rect) drawn at the top left of the screen, the whole map if None"""
         if not self._is_drawing:
             return
 
-        screen.blit(self._image, (0, 0))
-
+        image = self.image
         if self._is_drawing_debug or debug:
-            screen.blit(self._image_debug, (0, 0))
-            #self._mask.to_surface(screen)
+            image = self.image_with_debug
             #self._path_tree.draw(screen)
 
+        screen.blit(image, (0, 0), view)
+
 
 if __name__ == '__main__':
     pygame.init()
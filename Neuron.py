@@ -3,7 +3,6 @@
 import pygame
 
 import numpy as np
-import random
 import math
 
 from json import JSONEncoder
@@ -12,6 +11,7 @@ import json
 import config
 
 from Controls import Controls
+from Hud import Hud
 
 class NumpyArrayEncoder(JSONEncoder):
     def default(self, obj):
@@ -27,6 +27,19 @@ class NeuralNetwork(Controls):
 
     _is_drawing_activation = False
 
+    # Activation overlay (see draw): neurons drawn in columns, one per layer
+    DRAW_LAYERS = ['input', 'hidden', 'output']
+    DRAW_RADIUS = 20
+    DRAW_BORDER_PADDING = 22
+    DRAW_ROW_PADDING = 2
+    DRAW_COL_PADDING = 5
+    DRAW_FONT = 'LiberationBold'
+
+    _draw_layouts = {}      # Neurons centers of each layer, by layers sizes
+
+    # Version of the binary (.npz) brain files and population archives
+    FILE_FORMAT_VERSION = 1
+
     def __init__(self, input_count, hidden_count, output_count):
 
         hidden_size = (hidden_count, input_count + 1)
@@ -36,15 +49,70 @@ class NeuralNetwork(Controls):
 
         self._activation_data = None
 
+        self._batch = None
+        self._batch_row = None
+
+    @property
+    def activation_data(self):
+        if self._batch is not None:
+            return self._batch.activation_data(self._batch_row)
+        return self._activation_data
+
+    def bind(self, batch, row):
+        """Use the activation data of a NeuralNetworkBatch row (this brain evaluated in a population)"""
+        self._batch = batch
+        self._batch_row = row
+
     def copy(self):
         nn = NeuralNetwork(0, 0, 0)
         nn._hidden_layer = self._hidden_layer.copy()
         nn._output_layer = self._output_layer.copy()
         return nn
 
+    @property
+    def shape(self):
+        """(input_count, hidden_count, output_count)"""
+        return (self._hidden_layer.shape[1] - 1, self._hidden_layer.shape[0], self._output_layer.shape[0])
+
+    @staticmethod
+    def params_count(input_count, hidden_count, output_count):
+        return hidden_count * (input_count + 1) + output_count * (hidden_count + 1)
+
+    @staticmethod
+    def split_genomes(genomes, input_count, hidden_count, output_count):
+        """
+        Views of genomes [..., params_count] as hidden [..., hidden, inputs + 1]
+        and output [..., outputs, hidden + 1] layers (no copy)
+        """
+        hidden_size = hidden_count * (input_count + 1)
+        lead = genomes.shape[:-1]
+        hidden = genomes[..., :hidden_size].reshape(*lead, hidden_count, input_count + 1)
+        output = genomes[..., hidden_size:].reshape(*lead, output_count, hidden_count + 1)
+        return hidden, output
+
+    def to_genome(self):
+        """Flat copy of all the weights (hidden layer then output layer)"""
+        return np.concatenate((self._hidden_layer.ravel(), self._output_layer.ravel()))
+
+    @staticmethod
+    def from_genome(genome, input_count, hidden_count, output_count):
+        """The network layers are views of `genome` (not copied)"""
+        nn = NeuralNetwork(0, 0, 0)
+        nn._hidden_layer, nn._output_layer = NeuralNetwork.split_genomes(genome, input_count, hidden_count, output_count)
+        return nn
+
+    @staticmethod
+    def is_binary_file(file_name):
+        return str(file_name).endswith('.npz')
+
     @staticmethod
-    def load(json_file_name):
-        with open(json_file_name, 'r') as f:
+    def load(file_name):
+        """Loads a JSON or binary brain file (the first brain of a population archive)"""
+        if NeuralNetwork.is_binary_file(file_name):
+            genomes, shape = NeuralNetwork.load_genomes(file_name)
+            return NeuralNetwork.from_genome(genomes[0].copy(), *shape)
+
+        with open(file_name, 'r') as f:
             data = json.load(f)
 
         nn = NeuralNetwork(0, 0, 0)
@@ -53,11 +121,50 @@ class NeuralNetwork(Controls):
 
         return nn
 
-    def dump(self, json_file_name):
+    def dump(self, file_name):
+        """Saves the brain in binary format if `file_name` ends with .npz, in JSON otherwise"""
+        if NeuralNetwork.is_binary_file(file_name):
+            NeuralNetwork.dump_genomes(file_name, self.to_genome()[np.newaxis], self.shape)
+            return
+
         data = {'hidden':self._hidden_layer, 'output':self._output_layer}
-        with open(json_file_name, 'w') as f:
+        with open(file_name, 'w') as f:
             json.dump(data, f, cls=NumpyArrayEncoder)
 
+    @staticmethod
+    def load_genomes(file_name):
+        """
+        Genome matrix [brains, params_count] and shape (input_count, hidden_count, output_count)
+        of a population archive or of a brain file (binary or JSON, giving one brain)
+        """
+        if not NeuralNetwork.is_binary_file(file_name):
+            nn = NeuralNetwork.load(file_name)
+            return nn.to_genome()[np.newaxis], nn.shape
+
+        with np.load(file_name) as data:
+            version = int(data['version'])
+            shape = tuple(int(count) for count in data['shape'])
+            genomes = data['genomes']
+
+        if version > NeuralNetwork.FILE_FORMAT_VERSION:
+            raise ValueError(f'{file_name}: unsupported brain file version {version}')
+        if genomes.ndim != 2 or genomes.shape[1] != NeuralNetwork.params_count(*shape):
+            raise ValueError(f'{file_name}: genomes {genomes.shape} do not match the brain shape {shape}')
+
+        return genomes, shape
+
+    @staticmethod
+    def dump_genomes(file_name, genomes, shape):
+        """
+        Saves a population archive: the genome matrix [brains, params_count] (see to_genome)
+        and the brains shape, so the whole population is loaded back with one np.load
+        """
+        assert NeuralNetwork.is_binary_file(file_name)
+        np.savez(file_name,
+                 version=np.array(NeuralNetwork.FILE_FORMAT_VERSION),
+                 shape=np.array(shape),
+                 genomes=np.asarray(genomes, dtype=np.float64))
+
     @classmethod
     def event(cls, event):
         if event.type == pygame.KEYDOWN:
@@ -65,15 +172,6 @@ class NeuralNetwork(Controls):
             if cls.is_event_control(event, config.KEYS.NN.DEBUG.ACTIVATION):
                 cls._is_drawing_activation = not cls._is_drawing_activation
 
-    def mutate(self, rate, bound):
-        def mutate_func(value):
-            if random.random() < rate:
-                return value + random.gauss(0, 1) * bound
-            return value
-        mfunc = np.vectorize(mutate_func)
-        self._hidden_layer = mfunc(self._hidden_layer)
-        self._output_layer = mfunc(self._output_layer)
-
     @staticmethod
     def sigmoid(x):
         return 1. / (1. + math.exp(-x))
@@ -164,27 +262,37 @@ class NeuralNetwork(Controls):
         if not self._is_drawing_activation:
             return
 
-        radius = 20
-        border_padding = 22
-        row_padding = 2
-        col_padding = 5
+        activation_data = self.activation_data
+        if activation_data is None:
+            return
+
+        layers = [activation_data[layer].tolist() for layer in self.DRAW_LAYERS]
 
-        layers = ['input', 'hidden', 'output']
+        value_max = max([max(values) for values in layers])
+        value_min = min([min(values) for values in layers])
 
-        value_max = max([max(self._activation_data[x]) for x in layers])
-        value_min = min([min(self._activation_data[x]) for x in layers])
+        layout = self._draw_layout(tuple(len(values) for values in layers))
 
-        font = pygame.font.SysFont('LiberationBold', radius)
+        for values, centers in zip(layers, layout):
+            for value, center in zip(values, centers):
+                color = self.map_value_to_color(value, value_min, value_max)
+                pygame.draw.circle(screen, color, center, self.DRAW_RADIUS)
+                # Rendered once per value, as the values are drawn rounded
+                text = Hud.text(f'{value:.2f}', self.DRAW_FONT, self.DRAW_RADIUS)
+                screen.blit(text, text.get_rect(center=center))
 
-        for col_i, col in enumerate(layers):
-            for row_i, row in enumerate(self._activation_data[col]):
-                color = self.map_value_to_color(row, value_min, value_max)
-                x = col_i * radius * col_padding + border_padding
-                y = row_i * radius * row_padding + border_padding
-                pygame.draw.circle(screen, color, (x, y), radius)
-                text = font.render(f'{row:.2f}', True, (0, 0, 0))
-                off_x, off_y = (text.get_width() // 2, text.get_height() // 2)
-                screen.blit(text, (x - off_x, y - off_y))
+    @classmethod
+    def _draw_layout(cls, sizes):
+        """Neurons centers of each layer, computed once per layers sizes"""
+        layout = cls._draw_layouts.get(sizes)
+        if layout is None:
+            radius, border = cls.DRAW_RADIUS, cls.DRAW_BORDER_PADDING
+            layout = cls._draw_layouts[sizes] = [
+                [(col_i * radius * cls.DRAW_COL_PADDING + border, row_i * radius * cls.DRAW_ROW_PADDING + border)
+                 for row_i in range(size)]
+                for col_i, size in enumerate(sizes)
+            ]
+        return layout
 
     @staticmethod
     def map_value_to_color(value, value_min, value_max):
@@ -199,4 +307,86 @@ class NeuralNetwork(Controls):
         blue = int(255 * (1 - normalized_value))
 
         # Return the RGB color tuple
-        return (red, green, blue)
\ No newline at end of file
+        return (red, green, blue)
+
+
+class NeuralNetworkBatch(object):
+    """
+    Brains of a whole population stacked into weights tensors
+    ([pop, hidden, inputs + 1] and [pop, outputs, hidden + 1]) to evaluate all of them in one call.
+    """
+
+    def __init__(self, hidden_layers, output_layers):
+        assert hidden_layers.shape[0] == output_layers.shape[0]
+
+        self._hidden_layers = hidden_layers
+        self._output_layers = output_layers
+
+        pop_count, hidden_count, input_count = hidden_layers.shape
+        output_count = output_layers.shape[1]
+
+        # Last activation data of each brain for drawing
+        self._inputs = np.zeros((pop_count, input_count - 1))
+        self._hidden = np.zeros((pop_count, hidden_count))
+        self._output = np.zeros((pop_count, output_count))
+
+        # Weights of the brains of the rows evaluated, gathered without allocating (see forward)
+        self._hidden_rows = np.empty(hidden_layers.shape, dtype=hidden_layers.dtype)
+        self._output_rows = np.empty(output_layers.shape, dtype=output_layers.dtype)
+
+    def __len__(self):
+        return self._hidden_layers.shape[0]
+
+    @classmethod
+    def from_genomes(cls, genomes, brains):
+        """Weights tensors are views of the genome matrix [pop, params_count] of `brains` (not copied)"""
+        batch = cls(*NeuralNetwork.split_genomes(genomes, *brains[0].shape))
+        for row, brain in enumerate(brains):
+            brain.bind(batch, row)
+        return batch
+
+    @classmethod
+    def stack(cls, brains):
+        batch = cls(np.stack([brain._hidden_layer for brain in brains]),
+                    np.stack([brain._output_layer for brain in brains]))
+        for row, brain in enumerate(brains):
+            brain.bind(batch, row)
+        return batch
+
+    @staticmethod
+    def modified_sigmoid(x):
+        """Vectorized NeuralNetwork.modified_sigmoid"""
+        return 2. / (1. + np.exp(-x)) - 1.
+
+    @staticmethod
+    def _layer(layers, X):
+        return np.einsum('pni,pi->pn', layers[:, :, :-1], X) + layers[:, :, -1]
+
+    def forward(self, X, rows=slice(None)):
+        """
+        X: inputs of the brains of `rows`, as [len(rows), inputs]
+        Returns their outputs as [len(rows), outputs]
+        """
+        hidden_layers, output_layers = self._hidden_layers, self._output_layers
+        if not isinstance(rows, slice):
+            # Indices (the alive cars): copied in the preallocated buffers instead of new arrays at each step
+            count = len(rows)
+            hidden_layers = np.take(hidden_layers, rows, axis=0, out=self._hidden_rows[:count])
+            output_layers = np.take(output_layers, rows, axis=0, out=self._output_rows[:count])
+
+        with np.errstate(over='ignore'):
+            hidden = self.modified_sigmoid(self._layer(hidden_layers, X))
+            output = self.modified_sigmoid(self._layer(output_layers, hidden))
+
+        self._inputs[rows] = X
+        self._hidden[rows] = hidden
+        self._output[rows] = output
+
+        return output
+
+    def activation_data(self, row):
+        return {
+            'input': self._inputs[row],
+            'hidden': self._hidden[row],
+            'output': self._output[row],
+        }
@@ -0,0 +1,184 @@
+import numpy as np
+
+from CarPhysics import PopulationPhysics
+from CarAI import CarAI
+from Neuron import NeuralNetworkBatch
+from Sensors import Sensors
+from SpatialGrid import SpatialGrid
+from Timings import Timings
+
+
+class Population(object):
+    """
+    Cars of one generation. Their bodies are bound to one PopulationPhysics so the
+    physics of the whole population is advanced at once instead of car by car.
+    """
+
+    def __init__(self, cars, genomes=None):
+        """genomes: optional genome matrix [pop, params_count] the brains of the cars are views of"""
+        self._cars = list(cars)
+        self._physics = PopulationPhysics.bind([car.body for car in self._cars])
+
+        self._sensors_length = np.zeros((len(self._cars), Sensors.sensors_count()))
+        for row, car in enumerate(self._cars):
+            car.sensors.bind(self._sensors_length, row)
+
+        self._track = np.zeros((len(self._cars), 4))
+        for row, car in enumerate(self._cars):
+            car.bind_track(self._track, row)
+
+        # Brains are evaluated all at once when every car has one
+        self._genomes = genomes
+        self._brains = None
+
+        # Alive cars positions, built for the sensors seeing the cars only (see Sensors.sensing_cars)
+        self._grid = None
+        if self._cars and all(car.brain is not None for car in self._cars):
+            brains = [car.brain for car in self._cars]
+            if genomes is not None:
+                self._brains = NeuralNetworkBatch.from_genomes(genomes, brains)
+            else:
+                self._brains = NeuralNetworkBatch.stack(brains)
+
+    def __len__(self):
+        return len(self._cars)
+
+    def __iter__(self):
+        return iter(self._cars)
+
+    @property
+    def cars(self):
+        return self._cars
+
+    @property
+    def physics(self):
+        return self._physics
+
+    @property
+    def brains(self):
+        return self._brains
+
+    @property
+    def genomes(self):
+        return self._genomes
+
+    @property
+    def grid(self):
+        """SpatialGrid of the alive cars (ids are the rows of physics), None until updated (see update_grid)"""
+        return self._grid
+
+    def alive_cars(self):
+        return [car for car in self._cars if not car.is_dead]
+
+    @staticmethod
+    def _indices(cars):
+        return np.fromiter((car.body.index for car in cars), dtype=np.intp, count=len(cars))
+
+    @staticmethod
+    def warmup(game_map):
+        """
+        Runs the numba kernels of update() once, for a car at the start of game_map and with the same arguments types,
+        so they are compiled (or loaded from their cache) before the first step instead of stuttering it
+        """
+        front_pos = np.array([game_map.start_pos], dtype=np.float64)
+        heading = np.array([game_map.start_heading], dtype=np.float64)
+        indices = np.zeros(1, dtype=np.intp)
+
+        game_map.get_stonemiles(front_pos)
+        game_map.update_track(front_pos, np.array([[-1., 0., 0., 0.]]))
+        sensors_length = Sensors.raycast(game_map, front_pos, heading)
+        if Sensors.sensing_cars():
+            grid = SpatialGrid(game_map.size)
+            grid.update(front_pos, indices)
+            Sensors.raycast_cars(grid, front_pos, heading, indices, sensors_length, front_pos, heading)
+
+    def update_grid(self, game_map, indices=None):
+        """Puts the cars of indices (the alive ones by default) in the grid"""
+        if indices is None:
+            indices = self._indices(self.alive_cars())
+        if self._grid is None or self._grid.size != tuple(game_map.size):
+            self._grid = SpatialGrid(game_map.size)
+        self._grid.update(self._physics.pos[indices], indices)
+
+    def _update_sensors(self, game_map, indices):
+        if len(indices) == 0:
+            return
+        sensors_length = Sensors.raycast(game_map, self._physics.front_pos[indices],
+                                         self._physics.heading[indices])
+        if Sensors.sensing_cars():
+            self.update_grid(game_map, indices)
+            sensors_length = Sensors.raycast_cars(self._grid, self._physics.front_pos[indices], self._physics.heading[indices],
+                                                  indices, sensors_length, self._physics.pos, self._physics.heading)
+        self._sensors_length[indices] = sensors_length
+
+    def update(self, game_map, delta_time):
+        """
+        Same phases as Car.update, but each one is applied to all alive cars before the next one.
+        Returns the count of cars which were alive before this update.
+        """
+        cars = self.alive_cars()
+        alive_counter = len(cars)
+        if alive_counter == 0:
+            return 0
+
+        indices = self._indices(cars)
+
+        # Dead cars too, so they are not drawn between their last 2 steps anymore
+        self._physics.store_previous_pose()
+
+        start = Timings.start()
+        stonemiles = game_map.get_stonemiles(self._physics.front_pos[indices])
+        for car, stonemile in zip(cars, stonemiles.tolist()):
+            car.set_stonemile(stonemile)
+        Timings.stop('stonemiles', start)
+
+        start = Timings.start()
+        track = self._track[indices]
+        game_map.update_track(self._physics.front_pos[indices], track)
+        self._track[indices] = track
+        Timings.stop('track', start)
+
+        start = Timings.start()
+        self._update_sensors(game_map, indices)
+        Timings.stop('sensors', start)
+
+        start = Timings.start()
+        if self._brains is not None:
+            # Same inputs as CarAI.get_brain_inputs
+            inputs = np.column_stack((self._sensors_length[indices] / Sensors.SENSOR_SIZE_MAX,
+                                      self._physics.acceleration[indices]))
+            outputs = self._brains.forward(inputs, indices)
+            for car, car_outputs in zip(cars, outputs):
+                car.set_brain_outputs(car_outputs)
+            actions = CarAI.outputs_to_physics_actions(outputs)
+        else:
+            for car in cars:
+                car.update_actions()
+            actions = np.array([[car.actions.get(action, False) for action in PopulationPhysics.ACTIONS] for car in cars], dtype=bool)
+        Timings.stop('actions', start)
+
+        start = Timings.start()
+        self._physics.move(actions, delta_time, indices)
+        Timings.stop('move', start)
+
+        start = Timings.start()
+        for car in cars:
+            car.update_detection(game_map)
+        Timings.stop('detection', start)
+
+        start = Timings.start()
+        cars = [car for car in cars if not car.is_dead]
+        indices = self._indices(cars)
+        self._physics.update(delta_time, indices)
+        Timings.stop('physics', start)
+
+        start = Timings.start()
+        for car in cars:
+            car.update_epilog(game_map)
+
+        if Sensors.is_drawing():
+            # Update sensors length after move to draw them correctly
+            self._update_sensors(game_map, indices)
+        Timings.stop('epilog', start)
+
+        return alive_counter
@@ -2,16 +2,42 @@
 import math
 import pygame
 
+import numpy as np
+
 from numba import jit, prange
 
 import config
 
 from Controls import Controls
 
-from Map import Map
-
+from Map import mask_is_on_road
+from CarPhysics import CarPhysics
 from CacheMath import CacheMath
 
+
+@jit(nopython=True, cache=True)
+def ray_box_distance(x, y, dx, dy, half_w, half_h):
+    """
+    Distance along the ray from (x, y) in the direction (dx, dy) (normalized) to the box [-half_w, half_w] x [-half_h, half_h],
+    -1 when the ray misses it or starts in it
+    """
+    t_near = -math.inf
+    t_far = math.inf
+    for origin, direction, half in ((x, dx, half_w), (y, dy, half_h)):
+        if abs(direction) < 1e-12:
+            if abs(origin) > half:
+                return -1.
+            continue
+        t1 = (-half - origin) / direction
+        t2 = (half - origin) / direction
+        t_near = max(t_near, min(t1, t2))
+        t_far = min(t_far, max(t1, t2))
+
+    if t_near > t_far or t_near < 0.:
+        return -1.
+    return t_near
+
+
 class Sensors(Controls):
 
     __CONTROLS__ = {
@@ -22,18 +48,70 @@ class Sensors(Controls):
 
     _draw_sensors = False
 
-    _SENSORS_ANGLES = [-72, -36, 0, 36, 72]
+    RAYCASTING_MODES = ['sphere', 'pixel']     # Sphere tracing over the map distance field, or pixel by pixel march
+    _raycasting_mode = 'sphere'
+
+    _sensing_cars = False       # Rays stopped by the other cars too (see raycast_cars)
+
+    SENSORS_FIELD_OF_VIEW = 144     # in degrees, between the first and the last sensors
+
+    _SENSORS_ANGLES = np.array([-72., -36., 0., 36., 72.])
 
     def __init__(self, body):
         self._body = body
-        self._sensors_length = [0.] * self.count
+        self._sensors_length = np.zeros(self.count)
+
+    def bind(self, sensors_length, row):
+        """Use the row of a population sensors length array [cars, sensors] (see Population)"""
+        sensors_length[row] = self._sensors_length
+        self._sensors_length = sensors_length[row]
+
+    @classmethod
+    def sensors_count(cls):
+        return len(cls._SENSORS_ANGLES)
+
+    @classmethod
+    def sensors_angles(cls):
+        return cls._SENSORS_ANGLES
+
+    @classmethod
+    def set_sensors_angles(cls, angles):
+        """To be called before creating any car (the brains inputs depend on the sensors count)"""
+        cls._SENSORS_ANGLES = np.array(angles, dtype=np.float64)
+
+    @classmethod
+    def set_sensors_count(cls, count):
+        """Sensors evenly spread over SENSORS_FIELD_OF_VIEW"""
+        half_fov = cls.SENSORS_FIELD_OF_VIEW / 2
+        cls.set_sensors_angles(np.linspace(-half_fov, half_fov, count) if count > 1 else [0.])
+
+    @classmethod
+    def raycasting_mode(cls):
+        return cls._raycasting_mode
+
+    @classmethod
+    def set_raycasting_mode(cls, mode):
+        assert mode in cls.RAYCASTING_MODES, f"Unknown raycasting mode ({mode})"
+        cls._raycasting_mode = mode
+
+    @classmethod
+    def sensing_cars(cls):
+        return cls._sensing_cars
+
+    @classmethod
+    def set_sensing_cars(cls, sensing_cars):
+        cls._sensing_cars = bool(sensing_cars)
 
     @property
     def count(self):
-        return len(self._SENSORS_ANGLES)
+        return self.sensors_count()
 
     def get_all_sensors_length(self):
-        return [s / self.SENSOR_SIZE_MAX for s in self._sensors_length]
+        return (self._sensors_length / self.SENSOR_SIZE_MAX).tolist()
+
+    @classmethod
+    def is_drawing(cls):
+        return cls._draw_sensors
 
     @classmethod
     def event(cls, event):
@@ -43,29 +121,158 @@ class Sensors(Controls):
                 cls._draw_sensors = not cls._draw_sensors
 
     @staticmethod
-    @jit(nopython=True, fastmath=True, parallel=False)
-    def _raycasting(sensors_angles, sensor_size_max, heading, pos_x, pos_y, array, w, h):
-        sensors_length = [0.] * len(sensors_angles)
-        for i in prange(len(sensors_angles)):
-            angle = sensors_angles[i]
-            rad = math.radians(angle + heading)
-            sensors_length[i] = sensor_size_max
+    @jit(nopython=True, parallel=True, cache=True)
+    def _raycasting(sensors_angles, sensor_size_max, headings, positions, mask_array, bitpacked, w, h):
+        """
+        Rays of all sensors of all cars in parallel.
+        Returns the sensors length of each car as [cars, sensors]
+        """
+        cars_count = len(headings)
+        sensors_count = len(sensors_angles)
+        sensors_length = np.empty((cars_count, sensors_count))
+
+        for ray in prange(cars_count * sensors_count):
+            car = ray // sensors_count
+            i = ray % sensors_count
+
+            rad = math.radians(sensors_angles[i] + headings[car])
+            cos = math.cos(rad)
+            sin = math.sin(rad)
+            pos_x = positions[car, 0]
+            pos_y = positions[car, 1]
+
+            length = sensor_size_max
             for size in range(0, sensor_size_max, 1):
-                x = pos_x + (math.cos(rad) * size)
-                y = pos_y + (math.sin(rad) * size)
-                if not (0 <= x <= w and \
-                        0 <= y <= h and \
-                        array[int(x), int(y), 0] == 255):
-                    sensors_length[i] = size
+                x = pos_x + (cos * size)
+                y = pos_y + (sin * size)
+                if not (0 <= x < w and \
+                        0 <= y < h and \
+                        mask_is_on_road(mask_array, bitpacked, int(x), int(y))):
+                    length = size
+                    break
+            sensors_length[car, i] = length
+
+        return sensors_length
+
+    @staticmethod
+    @jit(nopython=True, parallel=True, cache=True)
+    def _sphere_tracing(sensors_angles, sensor_size_max, headings, positions, distance_array, w, h):
+        """
+        Same results as _raycasting, but each ray jumps by the distance to the nearest wall
+        (Map.distance_array) instead of walking one pixel at a time.
+        """
+        cars_count = len(headings)
+        sensors_count = len(sensors_angles)
+        sensors_length = np.empty((cars_count, sensors_count))
+
+        for ray in prange(cars_count * sensors_count):
+            car = ray // sensors_count
+            i = ray % sensors_count
+
+            rad = math.radians(sensors_angles[i] + headings[car])
+            cos = math.cos(rad)
+            sin = math.sin(rad)
+            pos_x = positions[car, 0]
+            pos_y = positions[car, 1]
+
+            length = sensor_size_max
+            size = 0
+            while size < sensor_size_max:
+                x = pos_x + (cos * size)
+                y = pos_y + (sin * size)
+                if not (0 <= x < w and \
+                        0 <= y < h):
+                    length = size
                     break
+                distance = distance_array[int(x), int(y)]
+                if distance == 0:
+                    length = size
+                    break
+                # Pixels of the skipped samples are all closer than the (floored) distance to the nearest wall
+                # (their centers are at most step - 1 + sqrt(2) away), so none of them can be a wall
+                size += max(1, distance - 1)
+            sensors_length[car, i] = length
 
         return sensors_length
 
+    @staticmethod
+    @jit(nopython=True, parallel=True, cache=True)
+    def _cars_raycasting(sensors_angles, headings, positions, sensors_length, offsets, neighbours,
+                         cars_pos, cars_cos, cars_sin, half_length, half_width):
+        """
+        Shortens the sensors length [cars, sensors] of the cars to their nearest neighbour car
+        (neighbours[offsets[car]:offsets[car + 1]], see SpatialGrid.query_radius), a rectangle around its position,
+        along its heading. The cars a ray starts in are ignored, so the overlapping cars (all of them at the start)
+        do not blind each other.
+        """
+        cars_count = len(headings)
+        sensors_count = len(sensors_angles)
+
+        for car in prange(cars_count):
+            x = positions[car, 0]
+            y = positions[car, 1]
+
+            rays_cos = np.empty(sensors_count)
+            rays_sin = np.empty(sensors_count)
+            for i in range(sensors_count):
+                rad = math.radians(sensors_angles[i] + headings[car])
+                rays_cos[i] = math.cos(rad)
+                rays_sin[i] = math.sin(rad)
+
+            for k in range(offsets[car], offsets[car + 1]):
+                other = neighbours[k]
+                ox = x - cars_pos[other, 0]
+                oy = y - cars_pos[other, 1]
+
+                # Rays in the frame of the other car
+                c = cars_cos[other]
+                s = cars_sin[other]
+                local_x = ox * c + oy * s
+                local_y = -ox * s + oy * c
+                if abs(local_x) <= half_length and abs(local_y) <= half_width:
+                    continue
+                for i in range(sensors_count):
+                    distance = ray_box_distance(local_x, local_y,
+                                                rays_cos[i] * c + rays_sin[i] * s,
+                                                -rays_cos[i] * s + rays_sin[i] * c,
+                                                half_length, half_width)
+                    if 0. <= distance < sensors_length[car, i]:
+                        sensors_length[car, i] = distance
+
+        return sensors_length
+
+    @classmethod
+    def raycast_cars(cls, grid, front_positions, headings, ids, sensors_length, cars_pos, cars_heading):
+        """
+        Sensors length [cars, sensors] (from raycast) of the cars `ids` at front_positions with headings,
+        shortened to the other cars of the SpatialGrid `grid`: rectangles around cars_pos, along cars_heading (indexed by id)
+        """
+        # Only the cars a ray can reach: within its longest sensor and the half diagonal of a car
+        half_diagonal = math.hypot(CarPhysics.HALF_WIDTH, CarPhysics.HALF_HEIGHT)
+        offsets, neighbours = grid.query_radius(front_positions, sensors_length.max(axis=1) + half_diagonal, exclude=ids)
+
+        rad = np.radians(cars_heading)
+        return cls._cars_raycasting(cls._SENSORS_ANGLES, headings, front_positions, sensors_length, offsets, neighbours,
+                                    cars_pos, np.cos(rad), np.sin(rad),
+                                    CarPhysics.HALF_WIDTH, CarPhysics.HALF_HEIGHT)
+
+    @classmethod
+    def raycast(cls, game_map, front_positions, headings):
+        """Sensors length [cars, sensors] of cars at front_positions [cars, 2] with headings [cars]"""
+        w, h = game_map.size
+
+        if cls._raycasting_mode == 'sphere':
+            return cls._sphere_tracing(cls._SENSORS_ANGLES, cls.SENSOR_SIZE_MAX,
+                                       headings, front_positions,
+                                       game_map.distance_array, w, h)
+
+        return cls._raycasting(cls._SENSORS_ANGLES, cls.SENSOR_SIZE_MAX,
+                               headings, front_positions,
+                               game_map.mask_array, game_map.mask_bitpacked, w, h)
+
     def _sensors_detection(self, game_map):
-        self._sensors_length = self._raycasting(self._SENSORS_ANGLES, self.SENSOR_SIZE_MAX,
-                                                self._body.heading,
-                                                self._body.front_pos[0], self._body.front_pos[1],
-                                                game_map.mask_array, game_map.mask_array.shape[0], game_map.mask_array.shape[1])
+        front_pos = self._body.front_pos
+        self._sensors_length[:] = self.raycast(game_map, np.array([front_pos]), np.array([self._body.heading]))[0]
 
     def update_prolog(self, game_map):
         self._sensors_detection(game_map)
@@ -75,11 +282,12 @@ class Sensors(Controls):
             # Update sensors length after move to draw them correctly
             self._sensors_detection(game_map)
 
-    def draw(self, screen, debug=False):
+    def draw(self, screen, debug=False, offset=(0, 0)):
         if self._draw_sensors:
-            start_pos = self._body.front_pos
+            start_pos = self._body.front_pos - offset
             pygame.draw.circle(screen, (0, 255, 0), start_pos, 5)
-            for angle, size in zip(self._SENSORS_ANGLES, self._sensors_length):
-                rad = CacheMath.radians(angle + self._body.heading)
-                end_pos = start_pos + (CacheMath.cos(rad) * size, CacheMath.sin(rad) * size)
+            # Drawn only: the tables are precise enough (the sensors themselves are cast with exact trigonometry)
+            rads = np.radians(self._SENSORS_ANGLES + self._body.heading)
+            ends = np.column_stack((CacheMath.cos_array(rads), CacheMath.sin_array(rads))) * self._sensors_length[:, None]
+            for end_pos in (ends + start_pos).tolist():
                 pygame.draw.line(screen, (255, 255, 255, 100), start_pos, end_pos)
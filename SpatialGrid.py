@@ -0,0 +1,156 @@
+import math
+
+import numpy as np
+
+from numba import jit, prange
+
+
+@jit(nopython=True, cache=True)
+def grid_cell(cell_size, cols, rows, x, y):
+    """Cell of a position, the positions out of the grid are in its border cells"""
+    col = min(max(int(x // cell_size), 0), cols - 1)
+    row = min(max(int(y // cell_size), 0), rows - 1)
+    return row * cols + col
+
+
+@jit(nopython=True, cache=True)
+def _grid_build(cell_size, cols, rows, positions):
+    """
+    Counting sort of the positions [n, 2] by cell: returns the first item of each cell [cells + 1]
+    and the order of the positions sorted by cell [n]
+    """
+    count = len(positions)
+    cells = np.empty(count, dtype=np.int64)
+    cell_start = np.zeros(cols * rows + 1, dtype=np.int64)
+    for k in range(count):
+        cells[k] = grid_cell(cell_size, cols, rows, positions[k, 0], positions[k, 1])
+        cell_start[cells[k] + 1] += 1
+
+    for cell in range(cols * rows):
+        cell_start[cell + 1] += cell_start[cell]
+
+    order = np.empty(count, dtype=np.int64)
+    filled = cell_start[:-1].copy()
+    for k in range(count):
+        order[filled[cells[k]]] = k
+        filled[cells[k]] += 1
+
+    return cell_start, order
+
+
+@jit(nopython=True, cache=True)
+def _grid_neighbours(cell_size, cols, rows, cell_start, items_ids, items_positions, x, y, exclude, radius, out, offset):
+    """Count of the items within `radius` of (x, y), their ids are stored from out[offset] if out is not empty"""
+    col_min = min(max(int((x - radius) // cell_size), 0), cols - 1)
+    col_max = min(max(int((x + radius) // cell_size), 0), cols - 1)
+    row_min = min(max(int((y - radius) // cell_size), 0), rows - 1)
+    row_max = min(max(int((y + radius) // cell_size), 0), rows - 1)
+
+    found = 0
+    for row in range(row_min, row_max + 1):
+        for col in range(col_min, col_max + 1):
+            cell = row * cols + col
+            for k in range(cell_start[cell], cell_start[cell + 1]):
+                if items_ids[k] == exclude:
+                    continue
+                dx = items_positions[k, 0] - x
+                dy = items_positions[k, 1] - y
+                if dx * dx + dy * dy <= radius * radius:
+                    if len(out) > 0:
+                        out[offset + found] = items_ids[k]
+                    found += 1
+    return found
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _grid_query_radius(cell_size, cols, rows, cell_start, items_ids, items_positions, points, exclude, radii):
+    """
+    Ids of the items within radii[i] of each points[i], as (offsets [points + 1], ids):
+    the neighbours of points[i] are ids[offsets[i]:offsets[i + 1]]
+    """
+    count = len(points)
+    no_out = np.empty(0, dtype=np.int64)
+
+    # 1st pass counts the neighbours of each point, 2nd one stores them
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    for i in prange(count):
+        offsets[i + 1] = _grid_neighbours(cell_size, cols, rows, cell_start, items_ids, items_positions,
+                                          points[i, 0], points[i, 1], exclude[i], radii[i], no_out, 0)
+    for i in range(count):
+        offsets[i + 1] += offsets[i]
+
+    ids = np.empty(offsets[count], dtype=np.int64)
+    for i in prange(count):
+        _grid_neighbours(cell_size, cols, rows, cell_start, items_ids, items_positions,
+                         points[i, 0], points[i, 1], exclude[i], radii[i], ids, offsets[i])
+
+    return offsets, ids
+
+
+class SpatialGrid(object):
+    """
+    Uniform grid of moving items (the cars), stored in flat arrays sorted by cell (like a sparse matrix):
+    rebuilt in O(n) by a counting sort at each update, and queried for many points at once.
+    """
+
+    CELL_SIZE = 64      # in pixels
+
+    def __init__(self, size, cell_size=CELL_SIZE):
+        """size: (w, h) of the area covered, the items out of it are in its border cells"""
+        self._size = tuple(size)
+        self._cell_size = cell_size
+        self._cols = max(math.ceil(self._size[0] / cell_size), 1)
+        self._rows = max(math.ceil(self._size[1] / cell_size), 1)
+
+        self.update(np.empty((0, 2)))
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def cell_size(self):
+        return self._cell_size
+
+    @property
+    def shape(self):
+        return self._cols, self._rows
+
+    @property
+    def cell_start(self):
+        """First item of each cell [cells + 1]: the items of a cell are items_*[cell_start[cell]:cell_start[cell + 1]]"""
+        return self._cell_start
+
+    @property
+    def items_ids(self):
+        return self._items_ids
+
+    @property
+    def items_positions(self):
+        return self._items_positions
+
+    def __len__(self):
+        return len(self._items_ids)
+
+    def update(self, positions, ids=None):
+        """Replaces the items by the ones at positions [n, 2], with ids [n] (their index by default)"""
+        positions = np.ascontiguousarray(positions, dtype=np.float64).reshape(-1, 2)
+        ids = np.arange(len(positions)) if ids is None else np.asarray(ids, dtype=np.int64)
+
+        self._cell_start, order = _grid_build(self._cell_size, self._cols, self._rows, positions)
+        self._items_ids = ids[order]
+        self._items_positions = positions[order]
+
+    def query_radius(self, points, radius, exclude=None):
+        """
+        Items within `radius` (or radius[i]) of each point [n, 2], as (offsets [n + 1], ids):
+        the ids of the items near points[i] are ids[offsets[i]:offsets[i + 1]].
+        exclude: id [n] not returned for each point (its own one), -1 for none
+        """
+        points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 2)
+        if exclude is None:
+            exclude = np.full(len(points), -1, dtype=np.int64)
+        radii = np.ascontiguousarray(np.broadcast_to(np.asarray(radius, dtype=np.float64), len(points)))
+        return _grid_query_radius(self._cell_size, self._cols, self._rows, self._cell_start,
+                                  self._items_ids, self._items_positions, points,
+                                  np.asarray(exclude, dtype=np.int64), radii)
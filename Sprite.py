@@ -0,0 +1,24 @@
+import pygame
+
+
+class RotatedSprite(object):
+    """
+    Image pre-rendered at every ANGLE_STEP degrees of heading,
+    so drawing it at any heading is a lookup and a blit instead of a rotation.
+    Needs a display mode to be set (the rotated images are converted to the display format).
+    """
+
+    ANGLE_STEP = 1.
+
+    def __init__(self, img, angle_step=ANGLE_STEP):
+        self._angle_step = angle_step
+        self._imgs = [pygame.transform.rotate(img, -i * angle_step).convert_alpha()
+                      for i in range(round(360. / angle_step))]
+
+    def get(self, heading):
+        """Image rotated to the nearest pre-rendered heading (in degrees, any range)"""
+        return self._imgs[round(float(heading) / self._angle_step) % len(self._imgs)]
+
+    def draw(self, screen, pos, heading):
+        img = self.get(heading)
+        screen.blit(img, img.get_rect(center=pos))
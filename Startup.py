@@ -0,0 +1,47 @@
+import time
+
+
+class Startup(object):
+    """
+    Wall time of the startup stages of a process (imports, display, game, kernels...), printed as a breakdown
+    once it is ready to run its first simulation step. A stage lasts from the end of the previous one,
+    the first one from the import of this module, which is to be imported first.
+    """
+
+    _last = time.perf_counter()     # End of the last stage
+    _stages = []                    # [(name, time)]
+    _reported = False
+
+    @classmethod
+    def stage(cls, name):
+        """Ends the stage `name` (ignored once the startup was reported)"""
+        if cls._reported:
+            return
+
+        now = time.perf_counter()
+        cls._stages.append((name, now - cls._last))
+        cls._last = now
+
+    @classmethod
+    def restart(cls, started=None):
+        """
+        Starts the stages over in a process forked from another one (see Worker), the first one lasting
+        from `started` (time.time() when the process was requested) if given
+        """
+        cls._last = time.perf_counter()
+        cls._stages = [] if started is None else [('process', time.time() - started)]
+        cls._reported = False
+
+    @classmethod
+    def total(cls):
+        return sum(elapsed for _, elapsed in cls._stages)
+
+    @classmethod
+    def report(cls, title='Startup'):
+        """Prints the stages timings, once"""
+        if cls._reported:
+            return
+        cls._reported = True
+
+        breakdown = ', '.join(f'{name} {elapsed:.2f}s' for name, elapsed in cls._stages)
+        print(f'{title}: {breakdown} (total {cls.total():.2f}s)', flush=True)
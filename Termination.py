@@ -0,0 +1,135 @@
+import numpy as np
+
+
+class Termination(object):
+    """
+    Generation-level termination policies, ending a generation before all of its cars are dead:
+     - step_budget: the generation has run for STEP_BUDGET steps
+     - stall: no alive car has reached a new stonemile for STALL_STEPS steps
+     - cannot_beat: no alive car can beat the best fitness before the end of the step budget (see CarAI.fitness_bound)
+    A policy is disabled when its parameter is 0 (or False).
+    The cars of a generation may be split in shards stepped in lockstep (see Evaluator): the Termination
+    of the generation then decides for all of them from the observations of the Terminations of the shards.
+    """
+
+    POLICIES = ['step_budget', 'stall', 'cannot_beat']
+
+    STEP_BUDGET = 0
+    STALL_STEPS = 0
+    CANNOT_BEAT = False
+
+    def __init__(self, cars, game_map, delta_time, laps_max, best_fitness=0.):
+        """
+        game_map, delta_time, laps_max: the ones the cars are run with (see CarAI.fitness_bound)
+        best_fitness: fitness to beat, besides the one of the cars (best of the previous generations)
+        """
+        self._cars = list(cars)
+        self._map = game_map
+        self._delta_time = delta_time
+        self._laps_max = laps_max
+        self._best_fitness = best_fitness
+
+        self._steps = 0
+        self._stonemiles = np.zeros(len(self._cars), dtype=np.int64)
+        self._last_progress_step = 0
+
+        self._policy = None
+        self._steps_saved = 0
+
+    @classmethod
+    def settings(cls):
+        return (cls.STEP_BUDGET, cls.STALL_STEPS, cls.CANNOT_BEAT)
+
+    @classmethod
+    def set_settings(cls, step_budget, stall_steps, cannot_beat):
+        cls.STEP_BUDGET = step_budget
+        cls.STALL_STEPS = stall_steps
+        cls.CANNOT_BEAT = cannot_beat
+
+    @property
+    def policy(self):
+        """Name of the policy which ended the generation, None if all its cars died by themselves"""
+        return self._policy
+
+    @property
+    def steps_saved(self):
+        """Steps the alive cars could still have lived without reaching a new stonemile"""
+        return self._steps_saved
+
+    def observe(self):
+        """(whether a car reached a new stonemile, count of alive cars) after a step of the cars"""
+        stonemiles = np.fromiter((car.stonemiles_count for car in self._cars), dtype=np.int64, count=len(self._cars))
+        progressed = bool(np.any(stonemiles > self._stonemiles))
+        self._stonemiles = stonemiles
+
+        return progressed, sum(1 for car in self._cars if not car.is_dead)
+
+    def fitness(self):
+        """Best fitness of the cars"""
+        return max((car.fitness for car in self._cars), default=-np.inf)
+
+    def can_beat(self, best_fitness, steps_left):
+        """Whether an alive car may reach best_fitness in steps_left steps"""
+        return any(car.fitness_bound(steps_left, self._delta_time, self._map, self._laps_max) >= best_fitness
+                   for car in self._cars if not car.is_dead)
+
+    def stop(self):
+        """Kills the alive cars, returns the steps they could still have lived without reaching a new stonemile"""
+        alive_cars = [car for car in self._cars if not car.is_dead]
+        for car in alive_cars:
+            car.dead()
+        return max((car.life_steps for car in alive_cars), default=0)
+
+    def _fired(self, shards, alive_shards):
+        if self.STEP_BUDGET > 0 and self._steps >= self.STEP_BUDGET:
+            return 'step_budget'
+
+        if self.STALL_STEPS > 0 and self._steps - self._last_progress_step >= self.STALL_STEPS:
+            return 'stall'
+
+        if self.CANNOT_BEAT and self.STEP_BUDGET > 0:
+            best_fitness = max(self._best_fitness, *(shard.fitness() for shard in shards))
+            steps_left = self.STEP_BUDGET - self._steps
+            if not any(shard.can_beat(best_fitness, steps_left) for shard in alive_shards):
+                return 'cannot_beat'
+
+        return None
+
+    def update(self, observations=None, shards=None):
+        """
+        To be called after each step of the generation.
+        Returns True when a policy fires, the alive cars being killed.
+        shards: Terminations of the shards of the generation (or their proxies, see Evaluator), with their
+        observations of the step (see observe), instead of the cars of this Termination
+        """
+        if self._policy is not None:
+            return False
+
+        if shards is None:
+            shards, observations = [self], [self.observe()]
+
+        self._steps += 1
+
+        if any(progressed for progressed, _ in observations):
+            self._last_progress_step = self._steps
+
+        alive_shards = [shard for shard, (_, alive_count) in zip(shards, observations) if alive_count > 0]
+        if not alive_shards:
+            return False
+
+        self._policy = self._fired(shards, alive_shards)
+        if self._policy is None:
+            return False
+
+        self._steps_saved = max(shard.stop() for shard in alive_shards)
+        return True
+
+    @property
+    def result(self):
+        """(policy, steps, steps_saved) of the generation, policy being None when none fired"""
+        return (self._policy, self._steps, self._steps_saved)
+
+    @staticmethod
+    def describe(result):
+        policy, steps, steps_saved = result
+        return f'{policy} ended the generation after {steps} steps (~{steps_saved} steps saved)'
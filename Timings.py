@@ -0,0 +1,165 @@
+import os
+import csv
+import json
+import time
+import cProfile
+
+import pygame
+
+import config
+
+from Controls import Controls
+from Hud import Hud
+
+
+class Timings(Controls):
+    """
+    Wall time and calls count of the game loop phases, accumulated per generation.
+    A phase is timed by a start()/stop() pair, which costs a call and a test while disabled.
+    """
+
+    __CONTROLS__ = {
+        config.KEYS.APP.DEBUG.TIMINGS: 'Toggle drawing the timings of the game loop phases',
+        config.KEYS.APP.DEBUG.PROFILE: 'Profile the next frames (cProfile)',
+    }
+
+    PROFILE_FRAMES = 120
+    PROFILE_DIR = 'profiles'
+
+    EXPORT_FILE = None      # .csv or .json file the timings of all generations are exported to (see export)
+
+    FONT_SIZE = 16
+    TEXT_COLOR = (255, 255, 255)
+    TEXT_BG_COLOR = (0, 0, 0, 180)
+
+    _enabled = False
+    _is_drawing = False
+
+    _generation = None
+    _phases = {}            # Phases of the current generation: {name: [time, calls]}
+    _history = []           # Phases of the ended generations: [(generation, name, time, calls)]
+
+    _profiler = None
+    _profile_frames_left = 0
+
+    @classmethod
+    def is_enabled(cls):
+        return cls._enabled
+
+    @classmethod
+    def enable(cls, enabled=True):
+        cls._enabled = enabled or cls._is_drawing or cls.EXPORT_FILE is not None
+
+    @classmethod
+    def start(cls):
+        if not cls._enabled:
+            return None
+        return time.perf_counter()
+
+    @classmethod
+    def stop(cls, phase, start):
+        if start is None:
+            return
+
+        elapsed = time.perf_counter() - start
+        timing = cls._phases.get(phase)
+        if timing is None:
+            cls._phases[phase] = [elapsed, 1]
+        else:
+            timing[0] += elapsed
+            timing[1] += 1
+
+    @classmethod
+    def start_generation(cls, generation):
+        """The phases timed so far are the ones of the previous generation"""
+        if cls._enabled and cls._phases:
+            cls._history.extend((cls._generation, phase, elapsed, calls) for phase, (elapsed, calls) in cls._phases.items())
+        cls._phases = {}
+        cls._generation = generation
+
+    @classmethod
+    def rows(cls):
+        """(generation, phase, time, calls) of all the generations, the current one included"""
+        current = [(cls._generation, phase, elapsed, calls) for phase, (elapsed, calls) in cls._phases.items()]
+        return cls._history + current
+
+    @classmethod
+    def dump(cls, file_name):
+        fields = ('generation', 'phase', 'time', 'calls')
+        if file_name.endswith('.json'):
+            with open(file_name, 'w') as f:
+                json.dump([dict(zip(fields, row)) for row in cls.rows()], f, indent=1)
+        else:
+            with open(file_name, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(fields)
+                writer.writerows(cls.rows())
+        print(f' - Saved timings to: {file_name}')
+
+    @classmethod
+    def export(cls):
+        if cls.EXPORT_FILE is not None:
+            cls.dump(cls.EXPORT_FILE)
+
+    @classmethod
+    def _start_profile(cls):
+        if cls._profiler is not None:
+            return
+
+        cls._profiler = cProfile.Profile()
+        cls._profile_frames_left = cls.PROFILE_FRAMES
+        cls._profiler.enable()
+        print(f'Profiling the next {cls.PROFILE_FRAMES} frames...')
+
+    @classmethod
+    def end_frame(cls):
+        if cls._profiler is None:
+            return
+
+        cls._profile_frames_left -= 1
+        if cls._profile_frames_left > 0:
+            return
+
+        cls._profiler.disable()
+        os.makedirs(cls.PROFILE_DIR, exist_ok=True)
+        fname = os.path.join(cls.PROFILE_DIR, f'profile_{time.strftime("%Y%m%d_%H%M%S")}.pstats')
+        cls._profiler.dump_stats(fname)
+        cls._profiler = None
+        print(f' - Saved profile to: {fname}')
+
+    @classmethod
+    def event(cls, event):
+        if event.type == pygame.KEYDOWN:
+            # Debug controls
+            if cls.is_event_control(event, config.KEYS.APP.DEBUG.TIMINGS):
+                cls._is_drawing = not cls._is_drawing
+                cls.enable(cls._is_drawing)
+            if cls.is_event_control(event, config.KEYS.APP.DEBUG.PROFILE):
+                cls._start_profile()
+
+    @classmethod
+    def draw(cls, screen):
+        if not cls._is_drawing:
+            return
+
+        total = sum(elapsed for elapsed, _ in cls._phases.values()) or 1.
+        lines = [f'Generation {cls._generation}: phase, total ms, share, calls, us/call']
+        for phase, (elapsed, calls) in sorted(cls._phases.items(), key=lambda item: -item[1][0]):
+            lines.append(f'{phase:<14} {elapsed * 1e3:>9.1f} {elapsed / total:>5.0%} {calls:>8} {elapsed / calls * 1e6:>9.1f}')
+
+        # Not cached: the timings change every frame
+        font = Hud.font('monospace', cls.FONT_SIZE)
+        surfaces = [font.render(line, True, cls.TEXT_COLOR) for line in lines]
+        w = max(surface.get_width() for surface in surfaces)
+        h = sum(surface.get_height() for surface in surfaces)
+
+        # At the top right, the neural network of the best car is drawn at the top left
+        x = screen.get_width() - w - 10
+        background = pygame.Surface((w + 10, h + 10), pygame.SRCALPHA)
+        background.fill(cls.TEXT_BG_COLOR)
+        screen.blit(background, (x, 0))
+
+        y = 5
+        for surface in surfaces:
+            screen.blit(surface, (x + 5, y))
+            y += surface.get_height()
@@ -0,0 +1,101 @@
+import os
+import signal
+import traceback
+
+import numpy as np
+import numba
+
+from Startup import Startup
+
+from CarAI import CarAI
+from Map import Map, track_update
+from Population import Population
+from Sensors import Sensors
+from Termination import Termination
+from Evaluator import Shard, SharedMap
+
+
+class Worker(object):
+    """
+    Worker process of an Evaluator, running the requests of its WorkerShard. This module only imports the simulation
+    (no App, no display) and is preloaded by the forkserver the workers are forked from (see Evaluator),
+    which also loads what they can share: each worker then only loads the parallel kernels.
+    """
+
+    _map = None     # Map attached by this worker process: (descriptor key, Map, shared memory blocks)
+
+    @staticmethod
+    def preload():
+        """
+        Loads the numba target and the kernels which do not start the numba threads (they are not fork safe),
+        with tiny arguments of the same types as the simulation ones
+        """
+        centerline = np.array([[0., 0.], [1., 0.]])
+        arcs = np.array([0., 1., 2.])
+        track_update(centerline, arcs, np.zeros((1, 2)), np.array([[-1., 0., 0., 0.]]), Map.CENTERLINE_WINDOW)
+
+    @classmethod
+    def _attach_map(cls, map_descriptor):
+        """Map of the descriptor, attached once"""
+        key = tuple(block_name for block_name, _, _ in map_descriptor['arrays'].values())
+        if cls._map is None or cls._map[0] != key:
+            if cls._map is not None:
+                for block in cls._map[2]:
+                    block.close()
+            cls._map = (key, *SharedMap.attach(map_descriptor))
+        return cls._map[1]
+
+    @classmethod
+    def _init(cls, settings, map_descriptor, started):
+        Startup.restart(started)
+
+        # The main process handles CTRL+C, and stops the workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        # One thread per worker: the parallelism comes from the processes
+        numba.set_num_threads(1)
+
+        sensors_angles, raycasting_mode, fitness_progress, termination_settings = settings
+        Sensors.set_sensors_angles(sensors_angles)
+        Sensors.set_raycasting_mode(raycasting_mode)
+        CarAI.FITNESS_PROGRESS = fitness_progress
+        Termination.set_settings(*termination_settings)
+        Startup.stage('settings')
+
+        # For a car only: the other kernels are already loaded, and this loads the ones of the raycasting
+        Population.warmup(cls._attach_map(map_descriptor))
+        Startup.stage('kernels')
+        Startup.report(f'Worker {os.getpid()} startup')
+
+    @classmethod
+    def run(cls, conn, settings, map_descriptor, started):
+        """
+        Runs the requests (method, args) of a WorkerShard until None: 'start' creates the Shard of a generation
+        (map descriptor, then the arguments of Shard), the others call its methods.
+        Replies (True, result), or (False, traceback) on errors.
+        settings: see Evaluator; started: time.time() when the process was requested (see Startup.restart)
+        """
+        cls._init(settings, map_descriptor, started)
+
+        shard = None
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+
+            method, args = request
+            try:
+                if method == 'start':
+                    descriptor, *args = args
+                    shard = Shard(cls._attach_map(descriptor), *args)
+                    result = None
+                else:
+                    result = getattr(shard, method)(*args)
+            except Exception:
+                conn.send((False, traceback.format_exc()))
+            else:
+                conn.send((True, result))
+
+
+# Imported by the forkserver before it forks the workers: they inherit these kernels (see Evaluator)
+Worker.preload()
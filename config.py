@@ -9,6 +9,14 @@ class _Dict(dict):
 KEYS = _Dict(
     APP = _Dict(
         QUIT = pygame.K_ESCAPE,
+        SPEED = _Dict(
+            UP = pygame.K_PAGEUP,
+            DOWN = pygame.K_PAGEDOWN,
+        ),
+        DEBUG = _Dict(
+            TIMINGS = pygame.K_t,
+            PROFILE = pygame.K_p,
+        ),
     ),
     GAME = _Dict(
         NEXT = _Dict(